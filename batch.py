@@ -16,21 +16,36 @@
 
 import os
 import sys
-import glob
+import traceback
+from util import has_level_extension
+from nw2png import convert_to_png
+from caching import print_cache_stats
+from script_munger import store_script_analyses
+from tileset import store_decoded_tilesets
 
 if __name__ == "__main__":
-    load_path = sys.argv[1]
+    paletted = "--paletted" in sys.argv
+    args = [arg for arg in sys.argv if arg != "--paletted"]
+    load_path = args[1]
     assert os.path.isdir(load_path)
-    found = glob.glob(os.path.join(load_path, "*.nw"))
-    found += glob.glob(os.path.join(load_path, "*.graal"))
-    found += glob.glob(os.path.join(load_path, "*.zelda"))
-    found += glob.glob(os.path.join(load_path, "*.editor"))
+    found = [os.path.join(load_path, name) for name in
+             sorted(os.listdir(load_path)) if has_level_extension(name)]
     picsfile = "sprites/pics1.png"
-    if len(sys.argv) > 2:
-        picsfile = sys.argv[2]
+    if len(args) > 2:
+        picsfile = args[2]
 
-    cmd = "python nw2png.py {0} {1}"
+    # the levels are converted in this process, so that the sprites and
+    # scripts they share are only looked up and analyzed once
+    store_script_analyses()
+    store_decoded_tilesets()
     for path in found:
-        print "\n # # # #  ", os.path.split(path)[-1], "  # # # #"
-        os.system(cmd.format(path, picsfile))
-    
+        level_name = os.path.split(path)[-1]
+        print "\n # # # #  ", level_name, "  # # # #"
+        out_path = os.path.join("out", level_name + ".png")
+        try:
+            convert_to_png(path, picsfile, "sprites", out_path, paletted)
+        except Exception:
+            traceback.print_exc()
+
+    print
+    print_cache_stats()
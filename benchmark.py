@@ -0,0 +1,1432 @@
+#!/usr/bin/env python
+
+#  Copyright (c) 2017, Aeva M. Palecek
+
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Micro-benchmarks for the hot paths of the level parsers and
+# renderers.  Each benchmark first checks that the current code
+# produces the same results as the implementation it replaced, and
+# then reports the time taken by both.
+#
+# Usage:
+#  > python benchmark.py [benchmark names...] [level files or folders...]
+#
+# If no levels are given, the files in reference_levels are used.
+
+import os
+import re
+import sys
+import math
+import time
+import struct
+import shutil
+import hashlib
+import tempfile
+import itertools
+
+import util
+import nw_parser
+import fingerprint
+import parser_common
+import script_munger
+import graal_parser
+import tileset
+import nw2png
+
+try:
+    import setlist
+except ImportError:
+    # setlist needs the sh module
+    setlist = None
+
+
+BENCHMARKS = []
+REPEAT = 20
+
+
+def benchmark(fn):
+    BENCHMARKS.append(fn)
+    return fn
+
+
+def best_time(fn, *args):
+    """
+    Returns the fastest time in seconds out of REPEAT calls to fn.
+    """
+    best = None
+    for i in range(REPEAT):
+        start = time.time()
+        fn(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def report(name, count, unit, before, after):
+    print "{}: {} {}".format(name, count, unit)
+    print " - before: {:.3f} ms".format(before * 1000)
+    print " - after:  {:.3f} ms".format(after * 1000)
+    if after > 0:
+        print " - speedup: {:.1f}x".format(before / after)
+
+
+def read_levels(paths, headers):
+    levels = []
+    for path in paths:
+        with open(path, "r") as reader:
+            raw = reader.read()
+        if raw[:8] in headers:
+            levels.append((path, raw))
+    return levels
+
+
+def legacy_decode_tile_stream(raw, offset, packet_size):
+    """
+    The per-bit tile stream decoder previously used by DotGraalParser.
+    """
+    packet_mask = (2**packet_size)-1
+    repeat_mask = 2**(packet_size-1)
+    tile_mask = packet_mask - repeat_mask
+
+    def get_packet(bit_index):
+        seek = int(offset + math.floor((bit_index / 8.0)))
+        start = (bit_index % 8)
+        count = int(math.ceil((start + packet_size) / 8.0))
+        bits = 0
+        for i in range(count):
+            bits += struct.unpack("<B", raw[seek+i])[0] << i * 8
+        return (bits >> start) & packet_mask
+
+    tiles = []
+    bit_index = 0
+    while len(tiles) < 64**2:
+        packet = get_packet(bit_index)
+        if packet & repeat_mask:
+            count = packet & 0xFF
+            first = get_packet(bit_index + packet_size) & tile_mask
+            if packet & 0x100:
+                second = get_packet(bit_index + packet_size * 2) & tile_mask
+                for i in range(count):
+                    tiles.append(first)
+                    tiles.append(second)
+                bit_index += packet_size * 3
+            else:
+                for i in range(count):
+                    tiles.append(first)
+                bit_index += packet_size * 2
+        else:
+            tiles.append(packet & tile_mask)
+            bit_index += packet_size
+    assert len(tiles) == 64**2
+    return tiles, bit_index
+
+
+@benchmark
+def tile_stream(paths):
+    levels = read_levels(paths, graal_parser.REVISIONS)
+    if not levels:
+        return
+
+    def decode_all(decoder):
+        for path, raw in levels:
+            version = graal_parser.REVISIONS.index(raw[:8])
+            packet_size = 13 if version >= graal_parser.GR_2 else 12
+            decoder(raw, 8, packet_size)
+
+    for path, raw in levels:
+        version = graal_parser.REVISIONS.index(raw[:8])
+        packet_size = 13 if version >= graal_parser.GR_2 else 12
+        assert legacy_decode_tile_stream(raw, 8, packet_size) == \
+            graal_parser.decode_tile_stream(raw, 8, packet_size), path
+
+    before = best_time(decode_all, legacy_decode_tile_stream)
+    after = best_time(decode_all, graal_parser.decode_tile_stream)
+    report("tile_stream", len(levels), ".graal levels", before, after)
+
+
+def legacy_scan_sections(raw, seek, version):
+    """
+    The regex based section splitter previously used by DotGraalParser.
+    """
+    sections = {}
+    scope = {"seek" : seek}
+
+    def cut(name, pattern):
+        start = scope["seek"]
+        matcher = re.match(pattern, raw[start:], re.DOTALL | re.MULTILINE)
+        scope["seek"] = start + len(matcher.group())
+        sections[name] = (start, scope["seek"])
+
+    cut("links", r'^[^#]*?#\n')
+    cut("baddies", r'^(...([^\n\\]*?\\[^\n\\]*?\\[^\n\\]*?)?\n)*?\xff\xff\xff\n')
+    if version >= graal_parser.GR_1:
+        cut("npcs", r'^(..[^#]*?#[^\n]*?\n)*?#\n')
+        cut("treasure", r'^(....\n)*?#\n')
+    sections["signs"] = (scope["seek"], len(raw))
+    return sections
+
+
+@benchmark
+def section_scan(paths):
+    cases = []
+    for path, raw in read_levels(paths, graal_parser.REVISIONS):
+        version = graal_parser.REVISIONS.index(raw[:8])
+        packet_size = 13 if version >= graal_parser.GR_2 else 12
+        bit_index = graal_parser.decode_tile_stream(raw, 8, packet_size)[1]
+        seek = int(8 + math.ceil((bit_index / 8.0)))
+        cases.append((raw, seek, version))
+    if not cases:
+        return
+
+    def scan_all(scanner):
+        for raw, seek, version in cases:
+            scanner(raw, seek, version)
+
+    for raw, seek, version in cases:
+        assert legacy_scan_sections(raw, seek, version) == \
+            graal_parser.scan_sections(raw, seek, version)
+
+    before = best_time(scan_all, legacy_scan_sections)
+    after = best_time(scan_all, graal_parser.scan_sections)
+    report("section_scan", len(cases), ".graal levels", before, after)
+
+
+def legacy_decode_sign_text(data):
+    """
+    The character at a time sign decoder previously used by
+    DotGraalParser.parse_signs.
+    """
+    text = u''
+    for char in re.findall(r'(v\*e[^f]*f|.)', data):
+        if len(char) > 1:
+            values = map(lambda x: graal_parser.GLYPHS[ord(x)-32], char[3:-1])
+            text += chr(int(''.join(values)))
+        else:
+            text += graal_parser.GLYPHS[ord(char)-32]
+    return text
+
+
+def sign_lines(paths):
+    """
+    Returns the encoded text of every sign in the given .graal files,
+    along with some long synthetic signs that use escape sequences.
+    """
+    lines = []
+    for path, raw in read_levels(paths, graal_parser.REVISIONS):
+        level = graal_parser.DotGraalParser(path)
+        start, end = level.find_sections(raw)[0]["signs"]
+        pattern = r'^(.)(.)([^\n]*)$'
+        flags = re.DOTALL | re.MULTILINE
+        lines += [sign[2] for sign in re.findall(pattern, raw[start:end], flags)]
+
+    encode = dict((glyph, chr(index + 32)) for index, glyph in
+                  reversed(list(enumerate(graal_parser.GLYPHS))))
+    escape = "v*e" + "".join(encode[digit] for digit in u"64") + "f"
+    for length in [10, 100, 1000]:
+        plain = "".join(encode[c] for c in u"Welcome to Graal! " * length)
+        lines.append(plain)
+        lines.append((plain[:20] + escape) * length)
+    return lines
+
+
+@benchmark
+def sign_glyphs(paths):
+    lines = sign_lines(paths)
+
+    def decode_all(decoder):
+        for line in lines:
+            decoder(line)
+
+    for line in lines:
+        assert legacy_decode_sign_text(line) == \
+            graal_parser.decode_sign_text(line), repr(line)
+
+    before = best_time(decode_all, legacy_decode_sign_text)
+    after = best_time(decode_all, graal_parser.decode_sign_text)
+    report("sign_glyphs", len(lines), "sign lines", before, after)
+
+
+def legacy_tokenize_nw(raw_data):
+    """
+    The whole-file regex scans previously used by DotNWParser, returning
+    the captured params of each kind of entity.
+    """
+    found = {"BOARD" : [], "NPC" : [], "LINK" : [], "BADDY" : [],
+             "CHEST" : [], "SIGN" : []}
+    pattern = r'BOARD (\d+) (\d+) (\d+) (\d+) ([{0}]+)'.format(nw_parser.BASE64)
+    for line in raw_data.split("\n"):
+        match = re.match(pattern, line)
+        if match:
+            found["BOARD"].append(match.groups())
+    patterns = [
+        ("NPC", r'^NPC ([^\s]+) (-?\d+) (-?\d+)$(.+?)NPCEND$',
+         re.DOTALL | re.MULTILINE),
+        ("LINK", r'^LINK (.+) (\d+) (\d+) (\d+) (\d+) ([^\s]+) ([^\s]+)$',
+         re.MULTILINE),
+        ("BADDY", r'^BADDY (-?\d+) (-?\d+) (\d+)\n([^\n]*)\n([^\n]*)\n([^\n]*)\nBADDYEND$',
+         re.MULTILINE),
+        ("CHEST", r'^CHEST (-?\d+) (-?\d+) (.*) (-?\d+)$', re.MULTILINE),
+        ("SIGN", r'^SIGN (-?\d+) (-?\d+)$(.+?)SIGNEND$',
+         re.DOTALL | re.MULTILINE),
+    ]
+    for keyword, pattern, flags in patterns:
+        found[keyword] = re.findall(pattern, raw_data, flags)
+    return found
+
+
+def synthetic_nw_level(npc_count):
+    """
+    Generates the text of a script heavy .nw level.
+    """
+    lines = ["GLEVNW01"]
+    for y in range(64):
+        lines.append("BOARD 0 {} 64 0 {}".format(y, "AAAB" * 32))
+    for i in range(npc_count):
+        lines.append("NPC - {} {}".format(i % 64, i / 64))
+        lines.append("if (playerenters) {")
+        lines += ["  message line {};".format(n) for n in range(40)]
+        lines.append("}")
+        lines.append("NPCEND")
+        lines.append("LINK level{}.nw 0 {} 1 1 30 30".format(i, i % 64))
+        lines.append("SIGN {} {}".format(i % 64, i / 64))
+        lines.append("Sign number {}".format(i))
+        lines.append("SIGNEND")
+    return "\n".join(lines) + "\n"
+
+
+@benchmark
+def nw_tokenize(paths):
+    levels = [raw.replace("\r\n", "\n") for path, raw in
+              read_levels(paths, ["GLEVNW01"])]
+    levels.append(synthetic_nw_level(100))
+
+    def tokenize_all(tokenizer):
+        for raw_data in levels:
+            tokenizer(raw_data)
+
+    def current(raw_data):
+        found = {"BOARD" : [], "NPC" : [], "LINK" : [], "BADDY" : [],
+                 "CHEST" : [], "SIGN" : []}
+        for keyword, params in nw_parser.tokenize(raw_data.split("\n")):
+            found[keyword].append(params)
+        return found
+
+    for raw_data in levels:
+        assert legacy_tokenize_nw(raw_data) == current(raw_data)
+
+    before = best_time(tokenize_all, legacy_tokenize_nw)
+    after = best_time(tokenize_all, current)
+    report("nw_tokenize", len(levels), ".nw levels", before, after)
+
+
+def legacy_decode_board_row(data, run):
+    """
+    The per-tile base64 decoder previously used by DotNWParser, which
+    follows the formula from nw_file_specification.org.
+    """
+    row = []
+    for i in range(run*2)[::2]:
+        aa = data[i:i+2]
+        di = nw_parser.BASE64.index(aa[0])*64 + nw_parser.BASE64.index(aa[1])
+        tx = di % 16
+        ty = di / 16
+        bx = ty / 32 * 16 + tx
+        by = ty % 32
+        row.append((bx, by))
+    return row
+
+
+@benchmark
+def nw_board_rows(paths):
+    rows = []
+    for path, raw in read_levels(paths, ["GLEVNW01"]):
+        for keyword, params in nw_parser.tokenize(raw.split("\n")):
+            if keyword == "BOARD":
+                rows.append((params[4], int(params[2])))
+
+    # every possible tile code, in rows of 64 tiles
+    codes = sorted(nw_parser.TILE_CODES.keys())
+    for start in range(0, len(codes), 64):
+        rows.append(("".join(codes[start:start+64]), 64))
+
+    def decode_all(decoder):
+        for data, run in rows:
+            decoder(data, run)
+
+    coords = nw_parser.TILE_COORDS
+    for data, run in rows:
+        assert legacy_decode_board_row(data, run) == \
+            [coords[tile] for tile in nw_parser.decode_board_row(data, run)]
+
+    before = best_time(decode_all, legacy_decode_board_row)
+    after = best_time(decode_all, nw_parser.decode_board_row)
+    report("nw_board_rows", len(rows), "BOARD rows", before, after)
+    print " - rows per second: {:.0f} before, {:.0f} after".format(
+        len(rows) / before, len(rows) / after)
+
+
+def legacy_board_hashes(board):
+    """
+    The tile and pallet hashes previously computed from the nested
+    list of tile coordinates that LevelParser.board used to be.
+    """
+    tile_hash = hashlib.sha1(str(board)).hexdigest()
+    pallet = list(set(itertools.chain.from_iterable(board)))
+    pallet.sort()
+    return tile_hash, hashlib.sha1(str(pallet)).hexdigest()
+
+
+def board_hashes(board):
+    tile_hash = hashlib.sha1(board.tostring()).hexdigest()
+    pallet = list(set(board.tiles))
+    pallet.sort()
+    return tile_hash, hashlib.sha1(str(pallet)).hexdigest()
+
+
+@benchmark
+def board_bulk(paths):
+    boards = []
+    for path in paths:
+        try:
+            level = util.load_level(path)
+        except Exception:
+            continue
+        nested = [list(column) for column in level.board]
+        boards.append((nested, level.board))
+    if not boards:
+        return
+
+    for nested, board in boards:
+        for x in range(64):
+            assert [nw_parser.TILE_COORDS[tile] for tile in board.column(x)] \
+                == nested[x]
+        legacy_pallet = set(itertools.chain.from_iterable(nested))
+        assert legacy_pallet == \
+            set(nw_parser.TILE_COORDS[tile] for tile in set(board.tiles))
+
+    before = best_time(lambda: [legacy_board_hashes(n) for n, b in boards])
+    after = best_time(lambda: [board_hashes(b) for n, b in boards])
+    report("board_bulk", len(boards), "level boards hashed", before, after)
+
+    nested, board = boards[0]
+    nested_size = sys.getsizeof(nested) + \
+        sum(sys.getsizeof(column) for column in nested)
+    board_size = sys.getsizeof(board.tiles)
+    print " - board storage: {} bytes before, {} bytes after".format(
+        nested_size, board_size)
+
+
+def legacy_fingerprints(nested, level):
+    """
+    The four level hashes as previously computed from the repr of the
+    nested board and of each entity's constructor inputs.
+    """
+    tile_hash, pallet_hash = legacy_board_hashes(nested)
+    combined = ''
+    for entity in level.actors + level.baddies + level.signs:
+        combined += str(entity.original_inputs)
+    content_hash = hashlib.sha1(str(combined)).hexdigest()
+    combined = str(nested)
+    for entity in level.actors + level.baddies + level.signs:
+        combined += str(entity.original_inputs)
+    level_hash = hashlib.sha1(str(combined)).hexdigest()
+    return tile_hash, pallet_hash, content_hash, level_hash
+
+
+@benchmark
+def fingerprints(paths):
+    levels = []
+    for path in paths:
+        try:
+            level = util.load_level(path)
+        except Exception:
+            continue
+        levels.append(([list(column) for column in level.board], level))
+    if not levels:
+        return
+
+    # Levels must be told apart by the new fingerprints exactly when
+    # they were told apart by the old hashes.
+    names = ["tile_hash", "pallet_hash", "content_hash", "level_hash"]
+    for digest in sorted(fingerprint.DIGESTS.keys()):
+        for a_nested, a in levels:
+            for b_nested, b in levels:
+                before = zip(legacy_fingerprints(a_nested, a),
+                             legacy_fingerprints(b_nested, b))
+                a_new = fingerprint.level_fingerprints(a, digest)
+                b_new = fingerprint.level_fingerprints(b, digest)
+                for name, (old_a, old_b) in zip(names, before):
+                    assert (old_a == old_b) == (a_new[name] == b_new[name])
+
+    before = best_time(
+        lambda: [legacy_fingerprints(n, level) for n, level in levels])
+    report("fingerprints", len(levels), "levels", before,
+           best_time(lambda: [fingerprint.level_fingerprints(level)
+                              for n, level in levels]))
+    for digest in sorted(fingerprint.DIGESTS.keys()):
+        after = best_time(
+            lambda: [fingerprint.level_fingerprints(level, digest)
+                     for n, level in levels])
+        print " - {}: {:.3f} ms".format(digest, after * 1000)
+
+
+@benchmark
+def load_projections(paths):
+    root = tempfile.mkdtemp()
+    try:
+        synthetic = os.path.join(root, "synthetic.nw")
+        with open(synthetic, "w") as out:
+            out.write(synthetic_nw_level(100))
+        levels = [path for path, raw in
+                  read_levels(paths, util.LEVEL_FORMATS.keys())]
+        levels.append(synthetic)
+
+        def scan(level):
+            return (level.fingerprints(), len(level.links), len(level.signs),
+                    len(level.actors), len(level.baddies), len(level.treasures))
+
+        tools = [
+            ("extract_text",
+             lambda path: util.load_level(path, text_only=True).extract_text(),
+             util.extract_text),
+        ]
+        if setlist is not None:
+            tools.append(
+                ("setlist",
+                 lambda path: scan(util.load_level(path, fast_mode=True)),
+                 lambda path: scan(util.load_level(
+                     path, fields=setlist.SCAN_FIELDS))))
+
+        for name, before_fn, after_fn in tools:
+            def load_all(load):
+                for path in levels:
+                    load(path)
+
+            for path in levels:
+                assert before_fn(path) == after_fn(path), (name, path)
+
+            before = best_time(load_all, before_fn)
+            after = best_time(load_all, after_fn)
+            report("load_projections ({})".format(name), len(levels),
+                   "levels", before, after)
+    finally:
+        shutil.rmtree(root)
+
+
+def synthetic_tileset(path):
+    """
+    Saves a noisy tileset the size of pics1.png to the given path.
+    """
+    from PIL import Image
+    size = (2048, 512)
+    data = os.urandom(size[0] * size[1] * 4)
+    Image.frombytes("RGBA", size, data).save(path)
+
+
+def legacy_tile_segments(tiles_path):
+    """
+    The tileset loader previously used by nw2png, which opened the
+    tileset and cut it into separate tile images for every level.
+    """
+    from PIL import Image
+    img = Image.open(tiles_path)
+    width = img.size[0] / parser_common.TILE_SIZE
+    height = img.size[1] / parser_common.TILE_SIZE
+    tiles = []
+    for x in range(width):
+        tiles.append([])
+        for y in range(height):
+            tiles[-1].append(img.crop(nw2png.tile_box(x, y)))
+    return tiles
+
+
+def legacy_generate_map(board, tiles):
+    from PIL import Image
+    img = Image.new('RGBA',(64*16, 64*16))
+    for index, tile_index in enumerate(board.tiles):
+        y, x = divmod(index, board.WIDTH)
+        tile_x, tile_y = parser_common.TILE_COORDS[tile_index]
+        try:
+            img.paste(tiles[tile_x][tile_y], nw2png.tile_box(x, y))
+        except IndexError:
+            pass
+    return img
+
+
+@benchmark
+def tileset_atlas(paths):
+    boards = [util.load_level(path, fields=("board",)).board for path, raw in
+              read_levels(paths, util.LEVEL_FORMATS.keys())]
+    if not boards:
+        return
+    root = tempfile.mkdtemp()
+    try:
+        tiles_path = os.path.join(root, "pics1.png")
+        synthetic_tileset(tiles_path)
+
+        def legacy_render():
+            return [legacy_generate_map(board, legacy_tile_segments(tiles_path))
+                    for board in boards]
+
+        def render():
+            return [nw2png.generate_map(board, tileset.load_tileset(tiles_path))
+                    for board in boards]
+
+        for before, after in zip(legacy_render(), render()):
+            assert before.tobytes() == after.tobytes()
+
+        before = best_time(legacy_render)
+        after = best_time(render)
+        report("tileset_atlas", len(boards), "boards", before, after)
+
+        # a cold start, with and without a decoded copy in the cache
+        def cold_load():
+            tileset.TILESETS.clear()
+            tileset.load_tileset(tiles_path)
+
+        before = best_time(cold_load)
+        tileset.store_decoded_tilesets()
+        tileset.load_tileset(tiles_path)
+        after = best_time(cold_load)
+        tileset.STORE_TILESETS = False
+        report("tileset_atlas", 1, "cold tileset loads", before, after)
+    finally:
+        shutil.rmtree(root)
+
+
+@benchmark
+def board_compositing(paths):
+    boards = [util.load_level(path, fields=("board",)).board for path, raw in
+              read_levels(paths, util.LEVEL_FORMATS.keys())]
+    if not boards:
+        return
+    root = tempfile.mkdtemp()
+    try:
+        tiles_path = os.path.join(root, "pics1.png")
+        synthetic_tileset(tiles_path)
+        tiles = tileset.load_tileset(tiles_path)
+
+        def paste_tiles(board):
+            # generate_map without numpy, which pastes one tile at a time
+            unvectorized = parser_common.Board(board.tiles)
+            unvectorized.as_numpy = lambda: None
+            return nw2png.generate_map(unvectorized, tiles)
+
+        def gather_tiles(board):
+            return nw2png.generate_map(board, tiles)
+
+        def composite_all(composite):
+            for board in boards:
+                composite(board)
+
+        for board in boards:
+            assert paste_tiles(board).tobytes() == gather_tiles(board).tobytes()
+
+        before = best_time(composite_all, paste_tiles)
+        after = best_time(composite_all, gather_tiles)
+        report("board_compositing", len(boards), "boards", before, after)
+        print " - levels per second: {:.0f} before, {:.0f} after".format(
+            len(boards) / before, len(boards) / after)
+    finally:
+        shutil.rmtree(root)
+
+
+def legacy_apply_effect(img, effect):
+    px = img.load()
+    for x in range(img.size[0]):
+        for y in range(img.size[1]):
+            old = map(lambda x: x/255.0, px[x,y])
+            new = [int(old[i] * effect[i]*255) for i in range(4)]
+            px[x,y] = tuple(new)
+
+
+def legacy_apply_area_effect(img, effect):
+    data = img.load()
+    for x in range(img.size[0]):
+        for y in range(img.size[1]):
+            pixel = []
+            alpha = nw2png.clamp(1.0-effect[3])
+            for c in range(3):
+                darkened = data[x,y][c] * alpha
+                tinted = darkened + (effect[c] * 255)
+                pixel.append(min(int(tinted), 255))
+            data[x,y] = tuple(pixel)
+
+
+def legacy_add_composite(dest, blit):
+    from PIL import Image
+    assert dest.size == blit.size
+    bg_data = dest.load()
+    fg_data = blit.load()
+    out = Image.new('RGBA', blit.size)
+    out_data = out.load()
+
+    for x in range(blit.size[0]):
+        for y in range(blit.size[1]):
+            data = []
+            alpha = fg_data[x,y][3]/255.0
+            for c in range(3):
+                lhs = bg_data[x,y][c]
+                rhs = int(fg_data[x,y][c] * alpha)
+                data.append(min(lhs+rhs, 255))
+            data.append(1)
+            out_data[x,y] = tuple(data)
+    return out
+
+
+def noise_image(size):
+    from PIL import Image
+    data = os.urandom(size[0] * size[1] * 4)
+    return Image.frombytes("RGBA", size, data)
+
+
+def max_difference(lhs, rhs):
+    from PIL import ImageChops
+    return max(high for low, high in ImageChops.difference(lhs, rhs).getextrema())
+
+
+# How far the effects may stray from the per pixel versions, in 0-255
+# channel values.  Only add_composite without numpy rounds differently,
+# when multiplying light sprites by their alpha.
+EFFECT_TOLERANCE = 1
+
+
+def check_effects(effects):
+    """
+    Asserts that the effects in nw2png match the per pixel versions
+    they replaced, for the given (r, g, b, a) effects.  Returns the
+    largest difference found.
+    """
+    worst = 0
+    for effect in effects:
+        base = noise_image((48, 40))
+        light = noise_image((48, 40))
+
+        before, after = base.copy(), base.copy()
+        legacy_apply_effect(before, effect)
+        nw2png.apply_effect(after, effect)
+        worst = max(worst, max_difference(before, after))
+
+        before, after = base.copy(), base.copy()
+        legacy_apply_area_effect(before, effect)
+        nw2png.apply_area_effect(after, effect)
+        worst = max(worst, max_difference(before, after))
+
+        before = legacy_add_composite(base, light)
+        after = nw2png.add_composite(base, light)
+        worst = max(worst, max_difference(before, after))
+    assert worst <= EFFECT_TOLERANCE
+    return worst
+
+
+def time_once(fn, *args):
+    """
+    Returns the time in seconds of a single call to fn, for work too
+    slow to repeat.
+    """
+    start = time.time()
+    fn(*args)
+    return time.time() - start
+
+
+@benchmark
+def lit_effects(paths):
+    levels = [util.load_level(path, fields=("board", "effects")) for path, raw
+              in read_levels(paths, util.LEVEL_FORMATS.keys())]
+    lit = [level for level in levels if level.effects]
+    if lit:
+        boards = [level.board for level in lit]
+        effects = [level.effects[0] for level in lit]
+    else:
+        # none of the levels set an area effect, so light them anyway
+        boards = [level.board for level in levels[:1]]
+        effects = [(0.1, 0.05, 0.2, 0.6)]
+    if not boards:
+        return
+
+    checked = effects + [
+        (0.0, 0.0, 0.0, 0.0), (1, 1, 1, 1), (0.5, 0.25, 1.5, 0.3),
+        (-0.2, 0.4, 0.8, 1.2), (2.0, 0.0, 0.7, -0.5)]
+    numpy_worst = check_effects(checked)
+    with_numpy, nw2png.numpy = nw2png.numpy, None
+    try:
+        fallback_worst = check_effects(checked)
+    finally:
+        nw2png.numpy = with_numpy
+    print "lit_effects: largest difference {} with numpy, {} without".format(
+        numpy_worst, fallback_worst)
+
+    root = tempfile.mkdtemp()
+    try:
+        tiles_path = os.path.join(root, "pics1.png")
+        synthetic_tileset(tiles_path)
+        tiles = tileset.load_tileset(tiles_path)
+        canvases = [nw2png.generate_map(board, tiles) for board in boards]
+    finally:
+        shutil.rmtree(root)
+
+    def light_levels(apply_area_effect):
+        for canvas, effect in zip(canvases, effects):
+            apply_area_effect(canvas.copy(), effect)
+
+    # the per pixel version takes seconds per level, so it runs once
+    before = time_once(light_levels, legacy_apply_area_effect)
+    after = best_time(light_levels, nw2png.apply_area_effect)
+    report("lit_effects", len(canvases), "area effects", before, after)
+
+    # light sprites, as drawn by add_actors for actors with an effect
+    sprites = [noise_image((32 + i % 4 * 16, 32 + i % 3 * 16))
+               for i in range(64)]
+    backgrounds = [noise_image(sprite.size) for sprite in sprites]
+
+    def draw_lights(apply_effect, add_composite):
+        for sprite, bg in zip(sprites, backgrounds):
+            sprite = sprite.copy()
+            apply_effect(sprite, (1.0, 0.8, 0.4, 0.9))
+            add_composite(bg, sprite)
+
+    before = time_once(draw_lights, legacy_apply_effect, legacy_add_composite)
+    after = best_time(draw_lights, nw2png.apply_effect, nw2png.add_composite)
+    report("lit_effects", len(sprites), "light sprites", before, after)
+
+
+def legacy_add_actors(out_img, actors):
+    from PIL import Image
+    for actor in actors:
+        if actor.image:
+            img_path = actor.image
+            img = Image.open(img_path).convert("RGBA")
+
+            shape = actor.clip
+            sprite = img.crop(nw2png.make_box(*shape))
+
+            if actor.effect:
+                nw2png.apply_effect(sprite, actor.effect)
+
+            x = actor.x * parser_common.TILE_SIZE
+            y = actor.y * parser_common.TILE_SIZE
+            paste_shape = [x, y] + list(sprite.size)
+
+            if actor.zoom:
+                new_x, new_y, new_w, new_h, scale = actor.zoom
+                sprite = sprite.resize([new_w, new_h])
+                x = new_x * parser_common.TILE_SIZE
+                y = new_y * parser_common.TILE_SIZE
+                paste_shape = [x, y] + list(sprite.size)
+
+            paste_box = nw2png.make_box(*paste_shape)
+            bg = out_img.crop(paste_box)
+            mixed = None
+            if actor.effect:
+                mixed = nw2png.add_composite(bg, sprite)
+            else:
+                mixed = Image.alpha_composite(bg, sprite)
+            out_img.paste(mixed, paste_box)
+
+
+@benchmark
+def sprite_variants(paths):
+    """
+    Draws a level crowded with copies of a few NPCs, some of them lit
+    or zoomed, as levels built from the same few sprites tend to be.
+    """
+    root = tempfile.mkdtemp()
+    try:
+        sheet_path = os.path.join(root, "npcs.png")
+        noise_image((256, 256)).save(sheet_path)
+        actors = []
+        for index in range(300):
+            actor = parser_common.Actor(index * 7 % 66 - 1, index * 13 % 66 - 1,
+                                        None, "", True)
+            actor.image = sheet_path
+            actor.clip = [index % 4 * 32, 0, 32, 48]
+            if index % 6 == 0:
+                actor.effect = [1.0, 0.8, 0.4, 0.9]
+            if index % 10 == 0:
+                actor.zoom = [actor.x - 0.5, actor.y - 0.5, 48, 72, 1.5]
+            actors.append(actor)
+        canvas = noise_image((1024, 1024))
+
+        def draw(add_actors):
+            nw2png.SPRITES.clear()
+            drawn = canvas.copy()
+            add_actors(drawn, actors)
+            return drawn
+
+        assert draw(legacy_add_actors).tobytes() == \
+            draw(nw2png.add_actors).tobytes()
+
+        before = best_time(draw, legacy_add_actors)
+        after = best_time(draw, nw2png.add_actors)
+        report("sprite_variants", len(actors), "actors", before, after)
+        print " - {}".format(nw2png.SPRITES.stats())
+    finally:
+        shutil.rmtree(root)
+
+
+@benchmark
+def paletted_boards(paths):
+    from PIL import Image
+    boards = [util.load_level(path, fields=("board",)).board for path, raw in
+              read_levels(paths, util.LEVEL_FORMATS.keys())]
+    if not boards:
+        return
+    root = tempfile.mkdtemp()
+    try:
+        # a palette tileset the size of pics1.png, with room for black
+        tiles_path = os.path.join(root, "pics1.png")
+        size = (2048, 512)
+        indices = "".join(chr(ord(byte) % 200) for byte in
+                          os.urandom(size[0] * size[1]))
+        pics = Image.frombytes("P", size, indices)
+        pics.putpalette([ord(byte) | 1 for byte in os.urandom(768)])
+        pics.save(tiles_path)
+        tiles = tileset.load_tileset(tiles_path)
+        out_path = os.path.join(root, "out.png")
+
+        def save_boards(indexed):
+            sizes = []
+            for board in boards:
+                if indexed:
+                    img = nw2png.generate_map(board, tiles, indexed=True)
+                else:
+                    img = nw2png.generate_map(board, tiles).convert("RGB")
+                img.save(out_path)
+                sizes.append(os.path.getsize(out_path))
+            return sizes
+
+        for board in boards:
+            assert tiles.can_index(board.tiles)
+            rgb = nw2png.generate_map(board, tiles).convert("RGB")
+            indexed = nw2png.generate_map(board, tiles, indexed=True)
+            assert indexed.convert("RGB").tobytes() == rgb.tobytes()
+
+        before = best_time(save_boards, False)
+        after = best_time(save_boards, True)
+        report("paletted_boards", len(boards), "boards", before, after)
+        print " - png size: {} bytes before, {} bytes after".format(
+            sum(save_boards(False)), sum(save_boards(True)))
+    finally:
+        shutil.rmtree(root)
+
+
+class LegacyEntity(object):
+    """
+    Stands in for the entity classes from before they used slots, which
+    kept their fields in a __dict__, along with a list of the arguments
+    they were created from.
+    """
+    def __init__(self, entity):
+        for name in type(entity).__slots__:
+            value = getattr(entity, name)
+            if type(value) == list:
+                value = list(value)
+            setattr(self, name, value)
+        if hasattr(entity, "original_inputs"):
+            self.original_inputs = list(entity.original_inputs)
+
+
+def resident_kb():
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def load_many_levels(sources, count, legacy, results):
+    """
+    Loads count levels from the given (path, contents) pairs, and puts
+    the growth in resident size on the results queue.  This is run in a
+    child process, so that each run starts from the same footprint.
+    """
+    start = resident_kb()
+    levels = []
+    for index in range(count):
+        path, raw = sources[index % len(sources)]
+        level = util.LEVEL_FORMATS[raw[:8]](path, raw)
+        level.populate(fastmode=True)
+        level.resolve()
+        if legacy:
+            for name in set(parser_common.ENTITY_LISTS.values()):
+                entities = getattr(level, name)
+                setattr(level, name, map(LegacyEntity, entities))
+        levels.append(level)
+    results.put(resident_kb() - start)
+
+
+@benchmark
+def entity_memory(paths):
+    from multiprocessing import Process, Queue
+    sources = read_levels(paths, util.LEVEL_FORMATS.keys())
+    sources.append(("synthetic.nw", synthetic_nw_level(100)))
+    count = 10000
+
+    def measure(legacy):
+        results = Queue()
+        child = Process(target=load_many_levels,
+                        args=(sources, count, legacy, results))
+        child.start()
+        grown = results.get()
+        child.join()
+        return grown / 1024.0
+
+    before = measure(True)
+    after = measure(False)
+    print "entity_memory: {} levels".format(count)
+    print " - before: {:.1f} MB".format(before)
+    print " - after:  {:.1f} MB".format(after)
+
+
+def legacy_file_search(name, extensions):
+    """
+    The recursive sprite search previously used by Actor.munge, which
+    walked the whole sprites directory for every lookup.
+    """
+    name = ".".join(name.split(".")[:-1])
+    tree = os.walk(parser_common.SPRITES_PATH, True, None, True)
+    for root, dirnames, filenames in tree:
+        for filename in filenames:
+            for ext in extensions:
+                if filename == name + "." + ext:
+                    return os.path.join(root, filename)
+    return None
+
+
+@benchmark
+def sprite_search(paths):
+    # a synthetic sprites directory of 100 folders of 50 files each
+    root = tempfile.mkdtemp()
+    try:
+        for folder in range(100):
+            folder_path = os.path.join(root, "folder%d" % folder)
+            os.mkdir(folder_path)
+            for sprite in range(50):
+                name = "sprite%d_%d.png" % (folder, sprite)
+                open(os.path.join(folder_path, name), "w").close()
+        parser_common.setup_paths(root, os.path.join(root, "out.png"))
+        queries = ["sprite%d_%d.gif" % (i * 7 % 100, i % 50) for i in range(40)]
+        queries += ["missing%d.png" % i for i in range(10)]
+
+        def search_all(search):
+            for query in queries:
+                search(query, ["png", "gif"])
+
+        for query in queries:
+            assert legacy_file_search(query, ["png", "gif"]) == \
+                parser_common.file_search(query, ["png", "gif"])
+
+        before = best_time(search_all, legacy_file_search)
+        after = best_time(search_all, parser_common.file_search)
+        report("sprite_search", len(queries), "lookups in 5000 sprites",
+               before, after)
+    finally:
+        shutil.rmtree(root)
+
+
+@benchmark
+def image_probe(paths):
+    from PIL import Image
+    root = tempfile.mkdtemp()
+    try:
+        images = []
+        for index in range(20):
+            img_path = os.path.join(root, "npc%d.png" % index)
+            Image.new("RGBA", (16 + index, 32 + index)).save(img_path)
+            images.append(img_path)
+        # the same few images are used by most npcs
+        lookups = [images[i * i % len(images)] for i in range(500)]
+
+        def legacy_probe(img_path):
+            img = Image.open(img_path)
+            return (img.size[0], img.size[1], img.mode)
+
+        def probe_all(probe):
+            for img_path in lookups:
+                probe(img_path)
+
+        for img_path in images:
+            assert legacy_probe(img_path) == parser_common.image_info(img_path)
+
+        before = best_time(probe_all, legacy_probe)
+        after = best_time(probe_all, parser_common.image_info)
+        report("image_probe", len(lookups), "npc image lookups", before, after)
+    finally:
+        shutil.rmtree(root)
+
+
+def legacy_munge(actor, tokens):
+    """
+    The directive search previously done by Actor.munge, which searched
+    the whole init block once per directive.  The x and y offsets are
+    searched as that code intended.  Its typo searched both axes with
+    the last x pattern instead, the one for x += and x -=.
+    """
+    def move(axis, match):
+        operator, value = match.groups()
+        old_value = getattr(actor, axis)
+        value = float(eval(value.replace(axis, str(old_value))))
+        if operator == "=":
+            setattr(actor, axis, value)
+        elif operator == "+=":
+            setattr(actor, axis, old_value + value)
+        elif operator == "-=":
+            setattr(actor, axis, old_value - value)
+
+    init_block = "\n".join([token + ";" for token in tokens])
+
+    offset_patterns = {}
+    offset_patterns['x'] = [
+        r'^ *x ?(=) ?((?:x? ?[\d/*+\-. ]+)|(?:[\d/*+\-. ]+ ?x?)) ?;',
+        r'^ *x ?(\+=|\-=) ?([\d/*+\-. ]+) ?;',
+    ]
+    offset_patterns['y'] = [
+        regex.replace('x', 'y') for regex in offset_patterns['x']]
+    flags = re.DOTALL | re.MULTILINE
+    for axis, patterns in offset_patterns.items():
+        for regex in patterns:
+            found = re.search(regex, init_block, flags)
+            if found:
+                move(axis, found)
+                break
+
+    if init_block.count('hide;'):
+        actor.image = None
+
+    if init_block.count("setimgpart") or init_block.count("setgifpart"):
+        pattern = r'set(?:img|gif)part ([^\s]+?) ?, ?([\d/*+-]+) ??, ?([\d/*+-]+) ??, ?([\d/*+-]+) ??, ?([\d/*+-]+) ?;'
+        found = re.findall(pattern, init_block)
+        if found:
+            actor.image = parser_common.img_search(found[0][0])
+            actor.clip = map(lambda x: eval(x), found[0][1:])
+
+    if init_block.count("drawaslight;"):
+        actor.layer = 2
+    elif init_block.count("drawunderplayer;"):
+        actor.layer = -1
+    elif init_block.count("drawoverplayer;"):
+        actor.layer = 1
+
+    if init_block.count("setcoloreffect"):
+        pattern = r'setcoloreffect ?([\d/*.+-]+) ?, ?([\d/*.+-]+)?, ?([\d/*.+-]+)?, ?([\d/*.+-]+);'
+        found = re.findall(pattern, init_block)
+        if found:
+            actor.effect = map(lambda x: eval(x) if len(x) > 0 else 0.0, found[0])
+
+    if init_block.count("setzoomeffect"):
+        found = re.findall(r'setzoomeffect ?([\d/*.+-]+) ?;', init_block)
+        if found:
+            zoom = float(eval(found[0]))
+            new_width = int(actor.clip[2] * zoom)
+            new_height = int(actor.clip[3] * zoom)
+            new_x = actor.x + (((new_width - actor.clip[2]) / 2.0) * -1) / 16
+            new_y = actor.y + (((new_height - actor.clip[3]) / 2.0) * -1) / 16
+            actor.zoom = [new_x, new_y, new_width, new_height, zoom]
+
+
+def synthetic_npc_scripts(count):
+    """
+    Generates NPC scripts with a few of the directives Actor.munge
+    looks for, among the many unrelated commands that typical NPC
+    scripts run when they are created.
+    """
+    directives = [
+        "x = x + 1.5", "y -= 2", "x += 0.5", "y = y - 1",
+        "setimgpart door.png,0,0,32,48", "setgifpart tree.gif,16,0,64,64",
+        "drawaslight", "drawunderplayer", "drawoverplayer", "hide",
+        "setcoloreffect 1,0.5,0.5,0.8", "setzoomeffect 1.5",
+    ]
+    filler = [
+        "dontblock", "timeout = 0.05", "message Hello!", "setshape 1,32,32",
+        "setstring client.door,open", "this.speed = 0.5", "showcharacter",
+        "setcharprop #3,head19.png", "setcharani idle,", "toweapons Lamp",
+    ]
+    scripts = []
+    for index in range(count):
+        lines = []
+        for line in range(3 + index % 4):
+            lines.append(directives[(index * 7 + line * 5) % len(directives)])
+        for line in range(20 + index % 100):
+            lines.insert((index + line * 3) % (len(lines) + 1),
+                         filler[(index + line) % len(filler)])
+        created = ";\n  ".join(lines[:len(lines) / 2])
+        immediate = ";\n".join(lines[len(lines) / 2:])
+        scripts.append("if (created) {\n  %s;\n}\n%s;\n"
+                       "if (playertouchsme) {\n  say 1;\n}" %
+                       (created, immediate))
+    return scripts
+
+
+def legacy_find_blocks(src, start=0, nesting=0, scope=None):
+    """
+    The recursive block parser previously used by find_immediates,
+    which matched against a copy of the rest of the script for every
+    line, brace, and comment.
+    """
+    if not scope:
+        scope = []
+    seek = start
+    accumulate = ''
+    while seek < len(src):
+        chunk = re.match(
+            r'^(.*?)({|}|\n|\Z|//.*?(?:\n|\Z)|/\*.*?(?:\*/|\Z))',
+            src[seek:], re.MULTILINE | re.DOTALL)
+        seek += chunk.end() - chunk.start()
+        text, event = chunk.groups()
+        if event.strip():
+            if event == '{':
+                if accumulate:
+                    scope.append(accumulate)
+                    accumulate = ''
+                seek, new_scope = legacy_find_blocks(
+                    src, seek, nesting + 1, [text + event])
+                scope.append(new_scope)
+                continue
+            accumulate += text + event
+            if event == '}':
+                if accumulate:
+                    scope.append(accumulate)
+                if nesting != 0:
+                    return seek, scope
+        else:
+            accumulate += text + event
+    if accumulate:
+        scope.append(accumulate)
+    if nesting == 0:
+        return scope
+    else:
+        return len(src), scope
+
+
+@benchmark
+def block_scaling(paths):
+    npc_scripts = synthetic_npc_scripts(200)
+    for src in npc_scripts:
+        assert legacy_find_blocks(src) == script_munger.find_blocks(src)
+
+    # class scripts made of many event handlers, a few levels deep
+    handler = ("if (playerchats && strequals(#c,open)) {\n"
+               "  // open the door\n"
+               "  if (this.locked == 0) {\n"
+               "    /* play the sound */ play door.wav;\n"
+               "    setimgpart door.png,0,0,32,48;\n"
+               "  }\n"
+               "}\n")
+    for count in [4, 16, 64, 256, 1024]:
+        src = handler * count
+        assert legacy_find_blocks(src) == script_munger.find_blocks(src)
+        before = best_time(legacy_find_blocks, src)
+        after = best_time(script_munger.find_blocks, src)
+        report("block_scaling", len(src), "byte script", before, after)
+
+
+@benchmark
+def actor_directives(paths):
+    scripts = [(src, script_munger.find_immediates(src))
+               for src in synthetic_npc_scripts(500)]
+
+    def make_actor(src):
+        actor = parser_common.Actor(10, 20, None, src, True)
+        actor.image = "npc.png"
+        actor.clip = [0, 0, 32, 32]
+        return actor
+
+    def state(actor):
+        return (actor.x, actor.y, actor.image, actor.clip, actor.zoom,
+                actor.effect, actor.layer)
+
+    def directives(actor, tokens):
+        actor.apply_directives(script_munger.find_directives(tokens))
+
+    for src, tokens in scripts:
+        before, after = make_actor(src), make_actor(src)
+        legacy_munge(before, tokens)
+        after.munge()
+        assert state(before) == state(after), src
+
+    # find_immediates is left out of the timings, as both share it
+    def munge_all(munge):
+        for src, tokens in scripts:
+            munge(make_actor(src), tokens)
+
+    before = best_time(munge_all, legacy_munge)
+    after = best_time(munge_all, directives)
+    report("actor_directives", len(scripts), "npc scripts", before, after)
+
+
+def legacy_actor_sort_fn(lhs, rhs):
+    """
+    The comparison function previously used to sort the actors of a
+    level for drawing.
+    """
+    if lhs.layer < rhs.layer:
+        return -1
+    elif lhs.layer > rhs.layer:
+        return 1
+
+    lhs_height = lhs.zoom[3] if lhs.zoom else lhs.clip[3]
+    lhs_x = lhs.zoom[0] if lhs.zoom else lhs.x
+    lhs_y = lhs.zoom[1] if lhs.zoom else lhs.y
+
+    rhs_height = rhs.zoom[3] if rhs.zoom else rhs.clip[3]
+    rhs_x = rhs.zoom[0] if rhs.zoom else rhs.x
+    rhs_y = rhs.zoom[1] if rhs.zoom else rhs.y
+
+    a = lhs_y + (lhs_height / parser_common.TILE_SIZE)
+    b = rhs_y + (rhs_height / parser_common.TILE_SIZE)
+
+    if a < b:
+        return -1
+    elif a > b:
+        return 1
+    elif lhs_x < rhs_x:
+        return -1
+    elif lhs_x > rhs_x:
+        return 1
+    else:
+        return 0
+
+
+@benchmark
+def render_order(paths):
+    actors = []
+    for index in range(2000):
+        actor = parser_common.Actor(index * 7 % 64, index * 13 % 64,
+                                    None, "", True)
+        actor.layer = index % 4 - 1
+        actor.clip = [0, 0, 32, 16 + index % 48]
+        if index % 5 == 0:
+            actor.zoom = [actor.x - 0.5, actor.y - 0.5, 48, 24 + index % 64, 1.5]
+        actors.append(actor)
+
+    def legacy_order():
+        return sorted(actors, legacy_actor_sort_fn)
+
+    def queue_order():
+        return list(parser_common.RenderQueue(actors))
+
+    assert legacy_order() == queue_order()
+
+    before = best_time(legacy_order)
+    after = best_time(queue_order)
+    report("render_order", len(actors), "actors", before, after)
+
+
+@benchmark
+def script_analysis(paths):
+    # most npcs in a corpus share one of a smaller set of scripts
+    scripts = synthetic_npc_scripts(100)
+    sources = [scripts[i * i % len(scripts)] for i in range(1000)]
+
+    def legacy_analyze(src):
+        commands = script_munger.find_immediates(src)
+        return commands, script_munger.find_directives(commands)
+
+    def analyze_all(analyze):
+        for src in sources:
+            analyze(src)
+
+    for src in scripts:
+        before = legacy_analyze(src)
+        after = script_munger.analyze_script(src)
+        assert before[0] == after[0]
+        assert vars(before[1]) == vars(after[1])
+
+    before = best_time(analyze_all, legacy_analyze)
+    after = best_time(analyze_all, script_munger.analyze_script)
+    report("script_analysis", len(sources), "npc scripts", before, after)
+    print " - {}".format(script_munger.SCRIPT_ANALYSES.stats())
+
+
+@benchmark
+def joined_scripts(paths):
+    root = tempfile.mkdtemp()
+    try:
+        scripts = synthetic_npc_scripts(20)
+        for index, src in enumerate(scripts):
+            with open(os.path.join(root, "class%d.txt" % index), "w") as out:
+                out.write(src)
+        parser_common.setup_paths(root, os.path.join(root, "out.png"))
+        # most npcs in a level join one of a few shared classes
+        joins = ["class%d" % (i * i % len(scripts)) for i in range(300)]
+
+        def legacy_join(name):
+            path = parser_common.file_search(name + ".txt", ["txt"])
+            with open(path, "r") as script:
+                return script_munger.find_immediates(script.read())
+
+        def join_all(join):
+            for name in joins:
+                join(name)
+
+        for name in joins:
+            assert legacy_join(name) == parser_common.joined_commands(name)
+
+        before = best_time(join_all, legacy_join)
+        after = best_time(join_all, parser_common.joined_commands)
+        report("joined_scripts", len(joins), "joins", before, after)
+    finally:
+        shutil.rmtree(root)
+
+
+@benchmark
+def expressions(paths):
+    # the kinds of expressions found in npc scripts, most of which are
+    # repeated many times over in a typical corpus
+    sources = ["1", "0.5", "32", "16*3", "x + 1.5", "x-2", "3/2", "1/2.0",
+               "0.8", "48 / 2", "x * 2", "2*16", "-1", "x+0.5", "010"]
+    cases = [(sources[(index * 7) % len(sources)], index % 64)
+             for index in range(2000)]
+
+    def legacy_evaluate(source, x):
+        return eval(source.replace("x", str(x)))
+
+    def current(source, x):
+        return script_munger.evaluate(source, {"x" : x})
+
+    def evaluate_all(evaluate):
+        for source, x in cases:
+            evaluate(source, x)
+
+    for source, x in cases:
+        before, after = legacy_evaluate(source, x), current(source, x)
+        assert before == after and type(before) == type(after), source
+
+    before = best_time(evaluate_all, legacy_evaluate)
+    after = best_time(evaluate_all, current)
+    report("expressions", len(cases), "script expressions", before, after)
+
+
+def find_paths(args):
+    paths = []
+    for arg in args:
+        if os.path.isdir(arg):
+            for dirpath, dir_names, file_names in os.walk(arg):
+                for file_name in sorted(file_names):
+                    paths.append(os.path.join(dirpath, file_name))
+        elif os.path.isfile(arg):
+            paths.append(arg)
+    return paths
+
+
+if __name__ == "__main__":
+    names = [fn.__name__ for fn in BENCHMARKS]
+    selected = [arg for arg in sys.argv[1:] if arg in names]
+    paths = find_paths([arg for arg in sys.argv[1:] if arg not in names])
+    if not paths:
+        paths = find_paths(["reference_levels"])
+
+    for fn in BENCHMARKS:
+        if not selected or fn.__name__ in selected:
+            fn(paths)
+            print
@@ -0,0 +1,359 @@
+
+#  Copyright (c) 2017, Aeva M. Palecek
+
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Helpers for data that is expensive to build, either kept in memory
+# or kept between runs of the converter, such as the sprite index.
+# Everything stored here can be rebuilt, so failing to read or write
+# the cache is never an error.
+
+import os
+import atexit
+import hashlib
+import tempfile
+import cPickle as pickle
+
+
+# Where cached data is written.  This may be overridden with the
+# NW_CONVERTER_CACHE environment variable.
+CACHE_PATH = os.environ.get(
+    "NW_CONVERTER_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "nw-converter"))
+
+
+def cache_file(kind, key):
+    """
+    Returns the path of the cache file for the given kind of data and
+    key, such as the absolute path the data was built from.
+    """
+    name = hashlib.sha1(key).hexdigest() + ".pickle"
+    return os.path.join(CACHE_PATH, kind, name)
+
+
+def load_cache(path):
+    """
+    Returns the object pickled at the given path, or None if there is
+    no usable cache file there.
+    """
+    try:
+        with open(path, "rb") as infile:
+            return pickle.load(infile)
+    except (IOError, EOFError, pickle.UnpicklingError,
+            AttributeError, ImportError, ValueError):
+        return None
+
+
+def save_cache(path, data):
+    """
+    Pickles the data to the given path.  The file is written under a
+    temporary name first, so that a concurrent reader never sees a
+    partially written cache.  Returns False if it could not be saved.
+    """
+    cache_dir = os.path.split(path)[0]
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        handle, temp_path = tempfile.mkstemp(".tmp", "", cache_dir)
+        with os.fdopen(handle, "wb") as outfile:
+            pickle.dump(data, outfile, pickle.HIGHEST_PROTOCOL)
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            # windows will not rename over an existing file
+            os.remove(path)
+            os.rename(temp_path, path)
+        return True
+    except (IOError, OSError):
+        return False
+
+
+
+
+# Caches that report their hits and misses, by name.  See cache_stats.
+CACHES = {}
+
+
+def register_cache(name, cache):
+    """
+    Adds a cache with hits and misses counters to those reported by
+    cache_stats, and returns it.
+    """
+    CACHES[name] = cache
+    return cache
+
+
+def cache_stats():
+    """
+    Returns the (hits, misses) of each registered cache, by name.
+    """
+    return dict((name, (cache.hits, cache.misses))
+                for name, cache in CACHES.items())
+
+
+def merge_cache_stats(all_stats):
+    """
+    Sums the results of cache_stats from several processes.
+    """
+    merged = {}
+    for stats in all_stats:
+        for name, (hits, misses) in stats.items():
+            total_hits, total_misses = merged.get(name, (0, 0))
+            merged[name] = (total_hits + hits, total_misses + misses)
+    return merged
+
+
+def print_cache_stats(stats=None):
+    """
+    Prints the hit rate of each cache that was used, either in this
+    process or in the given results of cache_stats.
+    """
+    if stats is None:
+        stats = cache_stats()
+    for name in sorted(stats.keys()):
+        hits, misses = stats[name]
+        if hits + misses:
+            print "{} cache: {} hits, {} misses ({:.1f}% hit rate)".format(
+                name, hits, misses, 100.0 * hits / (hits + misses))
+
+
+
+
+def append_cache(path, data):
+    """
+    Appends a pickle of the data to the file at the given path, which
+    read_appended reads back.  Returns False if it could not be saved.
+    """
+    cache_dir = os.path.split(path)[0]
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(path, "ab") as outfile:
+            pickle.dump(data, outfile, pickle.HIGHEST_PROTOCOL)
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def read_appended(path):
+    """
+    Returns the list of objects appended to the file at the given path
+    by append_cache.  Reading stops at the first one that can't be read,
+    such as one that is still being written.
+    """
+    found = []
+    try:
+        with open(path, "rb") as infile:
+            while True:
+                found.append(pickle.load(infile))
+    except (IOError, EOFError, pickle.UnpicklingError,
+            AttributeError, ImportError, ValueError, IndexError):
+        pass
+    return found
+
+
+
+
+class StoredCache(object):
+    """
+    A dict of cached data that is shared with other processes through a
+    file in the cache directory.  Each process appends the entries it
+    adds to a shard file of its own, in batches and when it exits, so
+    that saving never rewrites the whole store.  The shards are merged
+    into the main file the next time the cache is loaded.
+
+    If 'retain' is False, the entries added by this process are only
+    kept in memory until they are saved, for caches that already have an
+    LRUCache in front of them.
+    """
+    def __init__(self, kind, name, batch=64, retain=True):
+        self.path = cache_file(kind, name)
+        self.batch = batch
+        self.retain = retain
+        self.entries = None
+        self.unsaved = {}
+        self.hits = 0
+        self.misses = 0
+
+    def shard_paths(self):
+        cache_dir, name = os.path.split(self.path)
+        prefix = os.path.splitext(name)[0] + "."
+        try:
+            names = os.listdir(cache_dir)
+        except OSError:
+            return []
+        return [os.path.join(cache_dir, name) for name in sorted(names)
+                if name.startswith(prefix) and name.endswith(".shard")]
+
+    def load(self):
+        """
+        Returns the dict of entries, reading it from the cache files the
+        first time it is needed.  Any shards found are merged into the
+        main file and removed.
+        """
+        if self.entries is None:
+            self.entries = load_cache(self.path) or {}
+            shards = self.shard_paths()
+            for shard in shards:
+                for batch in read_appended(shard):
+                    self.entries.update(batch)
+            if shards and save_cache(self.path, self.entries):
+                # entries appended to a shard since it was read here are
+                # lost, which only costs a later cache miss
+                for shard in shards:
+                    try:
+                        os.remove(shard)
+                    except OSError:
+                        pass
+            atexit.register(self.save)
+        return self.entries
+
+    def lookup(self, key):
+        """
+        Returns the data stored for the key, or None.
+        """
+        data = self.load().get(key)
+        if data is None:
+            data = self.unsaved.get(key)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def store(self, key, data):
+        if self.retain:
+            self.load()[key] = data
+        self.unsaved[key] = data
+        if len(self.unsaved) >= self.batch:
+            self.save()
+
+    def save(self):
+        """
+        Appends any new entries to the shard file of this process.
+        """
+        if not self.unsaved:
+            return
+        shard = "%s.%d.shard" % (os.path.splitext(self.path)[0], os.getpid())
+        append_cache(shard, self.unsaved)
+        self.unsaved = {}
+
+
+class FileDataCache(StoredCache):
+    """
+    Caches data derived from the contents of files, by path.  An entry
+    is only used while the mtime and size of its file are unchanged.
+    """
+    def get(self, path, build):
+        """
+        Returns the cached data for the file at path, or calls
+        build(path) to create it.  Returns None if the file does not
+        exist.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        stamp = (stat.st_mtime, stat.st_size)
+        cached = self.load().get(path) or self.unsaved.get(path)
+        if cached and cached[0] == stamp:
+            self.hits += 1
+            return cached[1]
+
+        self.misses += 1
+        data = build(path)
+        self.store(path, (stamp, data))
+        return data
+
+
+
+
+class LRUCache(object):
+    """
+    A dict-like cache that holds at most 'size' entries, discarding the
+    least recently used entry to make room for a new one.  Counts its
+    hits and misses so that callers can report how well it is working.
+
+    If a 'weigh' function is given, such as one returning the number of
+    bytes an entry uses, the cache instead holds entries up to a total
+    weight of 'size'.
+    """
+    def __init__(self, size, weigh=None):
+        self.size = size
+        self.weigh = weigh
+        self.weight = 0
+        # Entries are kept in a circular linked list, from least to most
+        # recently used, of [previous, next, key, value, weight] links.
+        self.links = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, 0]
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.links)
+
+    def __contains__(self, key):
+        return key in self.links
+
+    def get(self, key, default=None):
+        link = self.links.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        # move the entry to the most recently used end
+        prev, next_ = link[0], link[1]
+        prev[1] = next_
+        next_[0] = prev
+        last = self.root[0]
+        last[1] = self.root[0] = link
+        link[0] = last
+        link[1] = self.root
+        return link[3]
+
+    def __setitem__(self, key, value):
+        link = self.links.pop(key, None)
+        if link is not None:
+            self.unlink(link)
+        weight = self.weigh(value) if self.weigh else 1
+        # make room, though an entry heavier than the whole cache is
+        # still kept until the next one is added
+        while self.links and self.weight + weight > self.size:
+            oldest = self.root[1]
+            self.unlink(oldest)
+            del self.links[oldest[2]]
+        last = self.root[0]
+        link = [last, self.root, key, value, weight]
+        last[1] = self.root[0] = link
+        self.links[key] = link
+        self.weight += weight
+
+    def unlink(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+        self.weight -= link[4]
+
+    def clear(self):
+        self.links.clear()
+        self.root[:] = [self.root, self.root, None, None, 0]
+        self.weight = 0
+
+    def stats(self):
+        if self.weigh:
+            return "{} hits, {} misses, {} entries weighing {} of {}".format(
+                self.hits, self.misses, len(self.links), self.weight,
+                self.size)
+        return "{} hits, {} misses, {} of {} entries".format(
+            self.hits, self.misses, len(self.links), self.size)
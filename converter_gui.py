@@ -29,7 +29,7 @@ gi.require_version('Gtk', '3.0')
 from gi.repository import GLib, Gtk, Gdk, GObject
 from nw2png import convert_to_png
 from nw2tiled import convert_to_tmx
-from util import find_level_parser
+from util import sniff_level_format, LEVEL_EXTENSIONS
 
 
 def run_jobs(window, converter, jobs):
@@ -156,11 +156,12 @@ class ConverterWindow(object):
     def add_level(self, path):
         def is_level(path):
             try:
-                find_level_parser(path)
-                return True
-            except:
-                print "Not a valid level file: %s" % path
-                return False
+                if sniff_level_format(path):
+                    return True
+            except IOError:
+                pass
+            print "Not a valid level file: %s" % path
+            return False
                 
         if os.path.isdir(path):
             for base_dir, dirs, files in os.walk(path):
@@ -228,9 +229,8 @@ class ConverterWindow(object):
 
         level_filter = Gtk.FileFilter()
         level_filter.set_name("Graal Level Files")
-        level_filter.add_pattern("*.nw")
-        level_filter.add_pattern("*.graal")
-        level_filter.add_pattern("*.zelda")
+        for extension in sorted(LEVEL_EXTENSIONS.keys()):
+            level_filter.add_pattern("*" + extension)
         chooser.add_filter(level_filter)
         
         level_filter = Gtk.FileFilter()
@@ -0,0 +1,133 @@
+
+#  Copyright (c) 2017, Aeva M. Palecek
+
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Level fingerprints are computed from a canonical binary encoding of
+# the level, rather than from python's repr of the board and entities,
+# so that they stay the same between interpreter versions and do not
+# depend on whether a string was decoded as str or unicode.
+
+import zlib
+import struct
+import hashlib
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+class ChecksumDigest(object):
+    """
+    Wraps one of zlib's running checksums in the same interface as the
+    hashlib digests.
+    """
+    def __init__(self, checksum, data=""):
+        self.checksum = checksum
+        self.value = checksum("")
+        self.update(data)
+
+    def update(self, data):
+        self.value = self.checksum(data, self.value)
+
+    def copy(self):
+        copied = ChecksumDigest(self.checksum)
+        copied.value = self.value
+        return copied
+
+    def hexdigest(self):
+        return "%08x" % (self.value & 0xffffffff)
+
+
+# The digests that fingerprints may be computed with.  sha1 is the
+# default, the others are faster but far more prone to collisions.
+DIGESTS = {
+    "sha1" : hashlib.sha1,
+    "md5" : hashlib.md5,
+    "crc32" : lambda data="": ChecksumDigest(zlib.crc32, data),
+    "adler32" : lambda data="": ChecksumDigest(zlib.adler32, data),
+}
+if xxhash is not None:
+    DIGESTS["xxh64"] = xxhash.xxh64
+
+
+DEFAULT_DIGEST = "sha1"
+
+
+def encode_value(value, chunks):
+    """
+    Appends the canonical encoding of an entity field to the list of
+    chunks.  Every value is tagged with its kind so that differently
+    typed values never share an encoding.
+    """
+    if value is None:
+        chunks.append("n")
+    elif isinstance(value, (int, long)):
+        chunks.append("i" + struct.pack("<q", value))
+    elif isinstance(value, float):
+        chunks.append("f" + struct.pack("<d", value))
+    elif isinstance(value, basestring):
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        chunks.append("s" + struct.pack("<I", len(value)))
+        chunks.append(value)
+    elif isinstance(value, (list, tuple)):
+        chunks.append("l" + struct.pack("<I", len(value)))
+        for item in value:
+            encode_value(item, chunks)
+    else:
+        raise TypeError("Cannot fingerprint value: %r" % (value,))
+
+
+def encode_entities(entities):
+    """
+    Returns the canonical encoding of the constructor inputs of the
+    given actors, baddies and signs.
+    """
+    chunks = []
+    for entity in entities:
+        encode_value(type(entity).__name__, chunks)
+        encode_value(entity.original_inputs, chunks)
+    return "".join(chunks)
+
+
+def encode_pallet(tiles):
+    """
+    Returns the canonical encoding of the set of tile indices used.
+    """
+    pallet = sorted(set(tiles))
+    return struct.pack("<%dH" % len(pallet), *pallet)
+
+
+def level_fingerprints(level, digest=DEFAULT_DIGEST):
+    """
+    Computes the tile, pallet, content, and level hashes of a level in
+    one pass, and returns them in a dict.  See the hash methods on
+    LevelParser for what each of them is used for.
+    """
+    new = DIGESTS[digest]
+    board = level.board
+    content = encode_entities(level.actors + level.baddies + level.signs)
+
+    tile_hasher = new(board.tostring())
+    level_hasher = tile_hasher.copy()
+    level_hasher.update(content)
+
+    return {
+        "tile_hash" : tile_hasher.hexdigest(),
+        "pallet_hash" : new(encode_pallet(board.tiles)).hexdigest(),
+        "content_hash" : new(content).hexdigest(),
+        "level_hash" : level_hasher.hexdigest(),
+    }
@@ -18,10 +18,17 @@ import os
 import re
 import sys
 import math
-import struct
 import string
 
-from parser_common import LevelParser, UnknownFileHeader
+from parser_common import LevelParser, UnknownFileHeader, MalformedLevel
+from parser_common import Board, ENTITY_TYPES, BoardRow, Link, Sign
+from parser_common import Actor, Baddy, TreasureBox
+from caching import FileDataCache, register_cache
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 REVISIONS = ("Z3-V1.00", # <- untested
@@ -73,6 +80,45 @@ GLYPHS += u";"
 GLYPHS += u"\n"
 
 
+# Maps each byte value to the glyph it encodes in sign text, or None
+# for bytes that have no glyph.
+GLYPH_TABLE = [GLYPHS[byte - 32] if byte - 32 < len(GLYPHS) else None
+               for byte in range(256)]
+
+
+# The escape sequence for arbitrary character codes is a control code,
+# followed by what decodes to "K(number)".
+GLYPH_ESCAPE = re.compile(r'v\*e[^f]*f')
+
+
+def decode_glyphs(data):
+    """
+    Decodes a string of sign bytes, each of which is a glyph sprite,
+    into unicode text.
+    """
+    try:
+        return u''.join([GLYPH_TABLE[byte] for byte in bytearray(data)])
+    except TypeError:
+        raise IndexError("Invalid glyph in sign text: %s" % repr(data))
+
+
+def decode_sign_text(data):
+    """
+    Decodes a line of sign data into unicode text.  Escape sequences
+    for arbitrary character codes are replaced with that character,
+    where the integer parsed from the embeded numeric string is the
+    character code for the symbol.
+    """
+    chunks = []
+    seek = 0
+    for escape in GLYPH_ESCAPE.finditer(data):
+        chunks.append(decode_glyphs(data[seek:escape.start()]))
+        chunks.append(chr(int(decode_glyphs(escape.group()[3:-1]))))
+        seek = escape.end()
+    chunks.append(decode_glyphs(data[seek:]))
+    return u''.join(chunks)
+
+
 TREASURES = [
     "greenrupee",
     "bluerupee",
@@ -101,160 +147,325 @@ TREASURES = [
     ]
 
 
+# Section offsets of previously scanned files, by path.  These are kept
+# between runs, so only the entries added by this process are held in
+# memory until they are saved.  See DotGraalParser.find_sections.
+SECTION_INDEX = register_cache(
+    "section", FileDataCache("sections", "level_sections", retain=False))
+
+
+# The tile stream starts just after the file header.
+TILES_OFFSET = 8
+
+
+# Upper bound on the number of packets needed to fill a board, assuming
+# no repeat packet has a count of zero.
+MAX_PACKETS = 3 * 64**2
+
+
+def unpack_packets(raw, offset, packet_size, count):
+    """
+    Unpacks the first 'count' little endian packets of 'packet_size'
+    bits from the tile stream that starts at byte 'offset' of 'raw',
+    and returns them as a list of ints.
+    """
+    stop = offset + (count * packet_size + 7) / 8
+    packet_mask = (2**packet_size)-1
+
+    if numpy is not None:
+        data = numpy.zeros(stop - offset + 2, numpy.uint32)
+        data[:stop - offset] = numpy.frombuffer(
+            raw, numpy.uint8, stop - offset, offset)
+        bits = numpy.arange(count, dtype=numpy.uint32) * packet_size
+        seek = bits >> 3
+        words = data[seek] | (data[seek+1] << 8) | (data[seek+2] << 16)
+        return ((words >> (bits & 7)) & packet_mask).tolist()
+
+    data = bytearray(raw[offset:stop]) + bytearray(2)
+    packets = []
+    for bit_index in xrange(0, count * packet_size, packet_size):
+        seek = bit_index >> 3
+        word = data[seek] | (data[seek+1] << 8) | (data[seek+2] << 16)
+        packets.append((word >> (bit_index & 7)) & packet_mask)
+    return packets
+
+
+def expand_tile_runs(packets, packet_size):
+    """
+    Expands the single and repeating packets of a tile stream into a
+    flat list of 64*64 tile indices.  Returns the tiles along with the
+    number of packets that were consumed.  Raises IndexError if the
+    packets run out before the board is full.
+    """
+    repeat_mask = 2**(packet_size-1)
+    tile_mask = repeat_mask - 1
+    double_mask = 0x100
+    count_mask = 0xFF
+
+    stop_at = 64**2
+    tiles = [0] * stop_at
+    filled = 0
+    index = 0
+    while filled < stop_at:
+        packet = packets[index]
+        if not packet & repeat_mask:
+            # draw a singular tile
+            tiles[filled] = packet & tile_mask
+            filled += 1
+            index += 1
+
+        elif packet & double_mask:
+            # draw a pair of tiles N times
+            count = packet & count_mask
+            pair = [packets[index+1] & tile_mask,
+                    packets[index+2] & tile_mask]
+            tiles[filled:filled + count * 2] = pair * count
+            filled += count * 2
+            index += 3
+
+        else:
+            # draw a single tile N times
+            count = packet & count_mask
+            tiles[filled:filled + count] = [packets[index+1] & tile_mask] * count
+            filled += count
+            index += 2
+
+    assert filled == stop_at
+    return tiles, index
+
+
+def decode_tile_stream(raw, offset, packet_size):
+    """
+    Decodes the tile stream that starts at byte 'offset' of 'raw'.
+    Returns a flat list of tile indices in row major order, and the
+    number of bits the stream occupied.
+    """
+    available = (len(raw) - offset) * 8 / packet_size
+    count = min(available, MAX_PACKETS)
+    while True:
+        packets = unpack_packets(raw, offset, packet_size, count)
+        try:
+            tiles, used = expand_tile_runs(packets, packet_size)
+            return tiles, used * packet_size
+        except IndexError:
+            if count == available:
+                raise
+            count = available
+
+
+def scan_to_hash(raw, seek):
+    """
+    Scans a section made of anything up to the first "#" on a line of
+    its own, such as the level links, and returns where it ends.
+    """
+    end = raw.find("#", seek)
+    if end == -1 or raw[end+1:end+2] != "\n":
+        raise MalformedLevel("Unterminated section at byte %s" % seek)
+    return end + 2
+
+
+def scan_baddies(raw, seek):
+    """
+    Scans the baddy section, which is made of lines starting with three
+    bytes of position and type data optionally followed by three
+    backslash separated strings, and is terminated by "\xff\xff\xff".
+    """
+    while raw[seek:seek+4] != "\xff\xff\xff\n":
+        end = raw.find("\n", seek + 3)
+        if end == -1:
+            raise MalformedLevel("Unterminated baddy at byte %s" % seek)
+        messages = raw[seek+3:end]
+        if messages and messages.count("\\") != 2:
+            raise MalformedLevel("Malformed baddy at byte %s" % seek)
+        seek = end + 1
+    return seek + 4
+
+
+def scan_npcs(raw, seek):
+    """
+    Scans the NPC section, which is made of two bytes of position
+    data, the image name, a "#", and a script on one line.
+    """
+    while raw[seek:seek+2] != "#\n":
+        script = raw.find("#", seek + 2)
+        end = raw.find("\n", script + 1) if script != -1 else -1
+        if end == -1:
+            raise MalformedLevel("Unterminated NPC at byte %s" % seek)
+        seek = end + 1
+    return seek + 2
+
+
+def scan_treasure(raw, seek):
+    """
+    Scans the treasure section, which is made of four byte lines.
+    """
+    while raw[seek:seek+2] != "#\n":
+        if raw[seek+4:seek+5] != "\n":
+            raise MalformedLevel("Malformed treasure at byte %s" % seek)
+        seek += 5
+    return seek + 2
+
+
+def scan_sections(raw, seek, version):
+    """
+    Finds the sections of a level that follow the tile stream, which
+    ends at byte 'seek'.  This walks each section once, front to back,
+    and returns a dict mapping section names to (start, end) offsets.
+    """
+    scanners = [("links", scan_to_hash), ("baddies", scan_baddies)]
+    if version >= GR_1:
+        scanners += [("npcs", scan_npcs), ("treasure", scan_treasure)]
+        if version == GR_0:
+            scanners.append(("mystery", scan_to_hash))
+
+    sections = {}
+    for name, scanner in scanners:
+        end = scanner(raw, seek)
+        sections[name] = (seek, end)
+        seek = end
+
+    if sections.has_key("mystery"):
+        start, end = sections["mystery"]
+        assert(raw[start:end] == "#\n")
+
+    sections["signs"] = (seek, len(raw))
+    return sections
+
+
 class DotGraalParser(LevelParser):
     """
     This class takes a path to a .graal encoded file, decodes it, and
     provides a means of easily accessing the contained data.
     """
 
+    HEADERS = REVISIONS
+    EXTENSIONS = (".graal", ".zelda", ".editor")
+
     def file_version(self):
         if not self.header in REVISIONS:
             raise UnknownFileHeader("Unknown header: %s" % self.header)
         return REVISIONS.index(self.header)
 
     
-    def parse(self, text_only = False):
+    def parse(self, kinds=ENTITY_TYPES):
         assert(self.version >= Z3_3)
-        raw = open(self._uri, "r").read()
+        raw = self.read_raw()
+        sections, tiles = self.find_sections(raw)
+        self.sections = sections
 
-        # we start at 8 to seek just after the file header
-        offset = 8
-        bits_read = 0
+        def section(name):
+            start, end = sections[name]
+            return raw[start:end]
 
+        def load_board():
+            if tiles is None:
+                decoded = self.decode_tiles(raw)[0]
+            else:
+                decoded = tiles
+            self.board = Board(decoded)
+
+        def loader(entities, name, *args):
+            return lambda: self.add_entities(
+                entities(section(name), *args))
+
+        if issubclass(BoardRow, kinds):
+            self.defer("board", load_board)
+        if issubclass(Link, kinds):
+            self.defer("links", loader(self.iter_links, "links"))
+        if issubclass(Baddy, kinds):
+            self.defer("baddies", loader(self.iter_baddies, "baddies"))
+        if issubclass(Actor, kinds) and sections.has_key("npcs"):
+            self.defer("actors", loader(
+                self.iter_npcs, "npcs", self._fastmode))
+        if issubclass(TreasureBox, kinds) and sections.has_key("treasure"):
+            self.defer("treasures", loader(self.iter_treasure, "treasure"))
+        if issubclass(Sign, kinds):
+            self.defer("signs", loader(self.iter_signs, "signs"))
+
+
+    def iter_entities(self, kinds=ENTITY_TYPES, fastmode=False):
+        assert(self.version >= Z3_3)
+        raw = self.read_raw()
+        sections, tiles = self.find_sections(raw)
+
+        if issubclass(BoardRow, kinds):
+            if tiles is None:
+                tiles = self.decode_tiles(raw)[0]
+            for y in range(64):
+                yield BoardRow(y, tiles[y*64:(y+1)*64])
+
+        streams = [
+            (Link, "links", self.iter_links),
+            (Baddy, "baddies", self.iter_baddies),
+            (Actor, "npcs", lambda blob: self.iter_npcs(blob, fastmode)),
+            (TreasureBox, "treasure", self.iter_treasure),
+            (Sign, "signs", self.iter_signs),
+        ]
+        for kind, name, entities in streams:
+            if issubclass(kind, kinds) and sections.has_key(name):
+                start, end = sections[name]
+                for entity in entities(raw[start:end]):
+                    yield entity
+
+
+    def print_debug_info(self):
+        LevelParser.print_debug_info(self)
+        print "SECTIONS:"
+        for name, (start, end) in sorted(self.sections.items(),
+                                         key=lambda item: item[1]):
+            print " - {}: bytes {} to {}".format(name, start, end)
+        print
+        print
+
+
+    def decode_tiles(self, raw):
+        """
+        Decodes the tile stream of the level, and returns the list of
+        tile indexes along with the bit index where the stream ends,
+        as decode_tile_stream does.
+        """
         # tile data is packed in intervals of 12 or 13 bits
         packet_size = 13 if self.version >= GR_2 else 12
-        
-        packet_mask = (2**packet_size)-1
-        repeat_mask = 2**(packet_size-1)
-        double_mask = 0x100
-        count_mask = 0xFF
-        tile_mask = packet_mask - repeat_mask
-
-        def get_packet(bit_index):
-            seek = int(offset + math.floor((bit_index / 8.0)))
-            start = (bit_index % 8)
-            count = int(math.ceil((start + packet_size) / 8.0))
-            bits = 0
-            for i in range(count):
-                assert seek + i <= len(raw)
-                bits += struct.unpack("<B", raw[seek+i])[0] << i * 8
-            packet = (bits >> start) & packet_mask
-            return packet
-
-        def decode_tile(bit_index):
-            packet = get_packet(bit_index)
-            repeat_mode = packet & repeat_mask
-            double_mode = packet & double_mask if repeat_mode else 0
-            count = packet & count_mask if repeat_mode else 0
-
-            if repeat_mode:
-                first = get_packet(bit_index + packet_size)
-                if double_mode:
-                    second = get_packet(bit_index + packet_size * 2)
-                    return {
-                        "next" : bit_index + packet_size * 3,
-                        "mode" : "double-repeat",
-                        "data" : (first & tile_mask, second & tile_mask),
-                        "count" : count,
-                    }
-                else:
-                    return {
-                        "next" : bit_index + packet_size * 2,
-                        "mode" : "single-repeat",
-                        "data" : first & tile_mask,
-                        "count" : count,
-                    }
-            else:
-                return {
-                    "next" : bit_index + packet_size,
-                    "mode" : "single",
-                    "data" : packet & tile_mask,
-                }
-
-        # now we loop until the tiles array is full
-        tiles = []
-        stop_at = 64**2
-        bit_index = 0
-        while len(tiles) < stop_at:
-            tile = decode_tile(bit_index)
-            bit_index = tile["next"]
-            
-            if tile["mode"] == "single":
-                # draw a singular tile
-                tiles.append(tile["data"])
-
-            elif tile["mode"] == "single-repeat":
-                # draw a single tile N times
-                for i in range(tile["count"]):
-                    tiles.append(tile["data"])
-
-            elif tile["mode"] == "double-repeat":
-                # draw a pair of tiles N times
-                for i in range(tile["count"]):
-                    tiles.append(tile["data"][0])
-                    tiles.append(tile["data"][1])
-            else:
-                raise NotImplementedError(
-                    "Unknown tile mode: " + tile["mode"])
-                    
-        assert len(tiles) == stop_at
-        for i in range(len(tiles)):
-            y = int(math.floor(i/64.0))
-            x = i%64
-            tile = tiles[i]
-            tx = tile % 16
-            ty = tile / 16
-            bx = ty / 32 * 16 + tx
-            by = ty % 32 
-            self.board[x][y] = (bx, by)
-
-        if self.version <= Z3_2:
-            # Return early for the first two revisions, since we don't
-            # what features they support.
-            #return
-            pass
-
-        after_tiles = int(offset + math.ceil((bit_index / 8.0)))
-        remainder = raw[after_tiles:]
-
-        def cut(pattern, data):
-            matcher = re.match(pattern, data, re.DOTALL | re.MULTILINE)
-            found = matcher.group()
-            return found, data[len(found):]
-
-        links, remainder = cut(r'^[^#]*?#\n', remainder)
-        if not text_only:
-            self.parse_links(links)
-
-        baddies, remainder = cut(r'^(...([^\n\\]*?\\[^\n\\]*?\\[^\n\\]*?)?\n)*?\xff\xff\xff\n', remainder)
-        if not text_only:
-            self.parse_baddies(baddies)
-
-        if self.version >= GR_1:
-            npcs, remainder = cut(r'^(..[^#]*?#[^\n]*?\n)*?#\n', remainder)
-            if not text_only:
-                self.parse_npcs(npcs)
-
-            treasure, remainder = cut(r'^(....\n)*?#\n', remainder)
-            if not text_only:
-                self.parse_treasure(treasure)
-
-            if self.version == GR_0:
-                mystery, remainder = cut(r'^([^#])*#\n', remainder)
-                assert(mystery == "#\n")
-
-        self.parse_signs(remainder)
+        return decode_tile_stream(raw, TILES_OFFSET, packet_size)
+
+
+    def find_sections(self, raw):
+        """
+        Returns a dict mapping the name of each section of the level
+        to its (start, end) byte offsets within the file.  If the tile
+        stream had to be decoded to find where it ends, the decoded
+        tiles are returned as well, otherwise None.
+
+        Section offsets are kept in a cache shared with other processes,
+        so that later scans of the same level need not walk the tile
+        stream again.
+        """
+        found = []
+
+        def scan(path):
+            tiles, bit_index = self.decode_tiles(raw)
+            after_tiles = int(TILES_OFFSET + math.ceil((bit_index / 8.0)))
+            sections = scan_sections(raw, after_tiles, self.version)
+            sections["tiles"] = (TILES_OFFSET, after_tiles)
+            found.append(tiles)
+            return sections
+
+        sections = SECTION_INDEX.get(os.path.abspath(self._uri), scan)
+        if sections is None:
+            # the level was not read from a file
+            sections = scan(self._uri)
+        return sections, (found[0] if found else None)
 
         
-    def parse_links(self, blob):
+    def iter_links(self, blob):
         pattern = r'^(.+) (\d+) (\d+) (\d+) (\d+) ([^\s]+) ([^\s]+)$'
         flags = re.MULTILINE
         links = re.findall(pattern, blob, flags)
         for link_params in links:
-            self.add_link(*link_params)
+            yield Link(*link_params)
 
 
-    def parse_baddies(self, blob):
+    def iter_baddies(self, blob):
         pattern = r'^(.)(.)(.)([^\n\\]*?)\\([^\n\\]*?)\\([^\n\\]*?)$'
         flags = re.DOTALL | re.MULTILINE
         baddies = re.findall(pattern, blob, flags)
@@ -263,10 +474,10 @@ class DotGraalParser(LevelParser):
             x, y, kind = map(ord, baddy[:3])
             assert(kind <= 9)
             strings = baddy[3:]
-            self.add_baddy(x, y, kind, strings)
+            yield Baddy(x, y, kind, strings)
 
 
-    def parse_npcs(self, blob):
+    def iter_npcs(self, blob, fastmode):
         pattern = r'^(.)(.)([^#]*)#([^\n]*?)$'
         flags = re.DOTALL | re.MULTILINE
         npcs = re.findall(pattern, blob, flags)
@@ -279,10 +490,10 @@ class DotGraalParser(LevelParser):
                 garbage = r'^(\xff|.*?\\.*?\\.*?)$'
                 if (re.match(garbage, npc_src) or not npc_src):
                     continue
-            self.add_actor(npc_x, npc_y, npc_img, npc_src)
+            yield Actor(npc_x, npc_y, npc_img, npc_src, fastmode)
 
 
-    def parse_treasure(self, blob):
+    def iter_treasure(self, blob):
         pattern = r'^(.)(.)(.)(.)$'
         flags = re.DOTALL | re.MULTILINE
         treasures = re.findall(pattern, blob, flags)
@@ -292,13 +503,13 @@ class DotGraalParser(LevelParser):
                y >= -1 and y <= 63 and \
                kind >= 0 and kind < len(TREASURES) and \
                sign >= -1:
-                self.add_treasure(x, y, TREASURES[kind], sign)
+                yield TreasureBox(x, y, TREASURES[kind], sign)
             else:
                 # garbage data >_<
                 break
 
 
-    def parse_signs(self, blob):
+    def iter_signs(self, blob):
         pattern = r'^(.)(.)([^\n]*)$'
         flags = re.DOTALL | re.MULTILINE
         signs = re.findall(pattern, blob, flags)
@@ -307,19 +518,5 @@ class DotGraalParser(LevelParser):
             params = sign
             x = ord(params[0]) - 32
             y = ord(params[1]) - 32
-            data = re.findall(r'(v\*e[^f]*f|.)', params[2])
-            text = u''
-            for char in data:
-                if len(char) > 1:
-                    # The escape sequence for arbitrary character
-                    # codes is a control code, followed by what
-                    # decodes to "K(number)".  The integer parsed from
-                    # the embeded numeric string is then the character
-                    # code for the symbol.
-                    values = map(lambda x: GLYPHS[ord(x)-32], char[3:-1])
-                    text += chr(int(''.join(values)))
-                else:
-                    # Char value is a sprite.
-                    text += GLYPHS[ord(char)-32]
-
-            self.add_sign(x, y, text)
+            text = decode_sign_text(params[2])
+            yield Sign(x, y, text)
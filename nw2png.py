@@ -16,10 +16,17 @@
 
 import os
 import sys
-from PIL import Image
+from PIL import Image, ImageChops
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from util import load_level
-from parser_common import setup_paths, TILE_SIZE
+from parser_common import setup_paths, TILE_SIZE, TILE_COORDS
+from tileset import load_tileset
+from caching import LRUCache, register_cache
 
 
 def make_box(x, y, w=TILE_SIZE, h=TILE_SIZE):
@@ -30,161 +37,228 @@ def tile_box(x, y):
     return make_box(x * TILE_SIZE, y * TILE_SIZE)
 
 
-def tile_segments(tiles_path):
-    img = Image.open(tiles_path)
-    width = img.size[0] / TILE_SIZE
-    height = img.size[1] / TILE_SIZE
-    tiles = []
-    for x in range(width):
-        tiles.append([])
-        for y in range(height):
-            col = tiles[-1]
-            box = tile_box(x, y)
-            col.append(img.crop(box))
-    return tiles
-
-
-def generate_map(board, tiles):
-    img = Image.new('RGBA',(64*16, 64*16))
-    for x in range(64):
-        for y in range(64):
-            tile_x, tile_y = board[x][y]
-            try:
-                tile = tiles[tile_x][tile_y]
-                box = tile_box(x, y)
-                img.paste(tile, box)
-            except:
-                pass
-    return img
-
+def generate_map(board, tileset, fill=(0, 0, 0, 0), indexed=False):
+    """
+    Draws the tiles of a board.  Tiles that are outside of the tileset
+    are drawn in the fill color.
 
-def apply_effect(img, effect):
-    px = img.load()
-    for x in range(img.size[0]):
-        for y in range(img.size[1]):
-            old = map(lambda x: x/255.0, px[x,y])
-            new = [int(old[i] * effect[i]*255) for i in range(4)]
-            px[x,y] = tuple(new)
+    If indexed is True, the board is drawn as a palette image with the
+    palette of the tileset instead, and tiles outside of the tileset are
+    drawn in black.  See Tileset.can_index.
+    """
+    mode = "RGBA"
+    if indexed:
+        mode, fill = "P", tileset.fill_index or 0
+
+    board_tiles = board.as_numpy()
+    if board_tiles is not None:
+        pixels = tileset.gather(board_tiles, fill, indexed)
+        img = Image.fromarray(pixels, mode)
+    else:
+        img = Image.new(mode, (64*16, 64*16), fill)
+        for index, tile_index in enumerate(board.tiles):
+            y, x = divmod(index, board.WIDTH)
+            tile = tileset.tile(*TILE_COORDS[tile_index], indexed=indexed)
+            if tile is not None:
+                img.paste(tile, tile_box(x, y))
+    if indexed:
+        img.putpalette(tileset.palette)
+    return img
 
 
 def clamp(value, high=1.0, low=0.0):
     return max(min(value, high), low)
 
 
+# The effects below match the per pixel arithmetic the converter has
+# always used, truncating each channel to an integer and clipping it to
+# 0-255.  Effects that depend only on the value of each channel are
+# drawn through a lookup table of all 256 values.
+
+def clip_channel(value):
+    return max(min(int(value), 255), 0)
+
+
+# Lookup tables for Image.point by the effect they draw, as levels tend
+# to reuse the same few effects for many actors.
+EFFECT_TABLES = LRUCache(256)
+
+
+def effect_table(kind, effect, build):
+    key = (kind, tuple(effect))
+    table = EFFECT_TABLES.get(key)
+    if table is None:
+        table = EFFECT_TABLES[key] = build(effect)
+    return table
+
+
+def color_effect_table(effect):
+    table = []
+    for factor in effect[:4]:
+        table += [clip_channel(value / 255.0 * factor * 255)
+                  for value in range(256)]
+    return table
+
+
+def area_effect_table(effect):
+    alpha = clamp(1.0-effect[3])
+    table = []
+    for color in effect[:3]:
+        table += [clip_channel(value * alpha + color * 255)
+                  for value in range(256)]
+    return table + [255] * 256
+
+
+def apply_effect(img, effect):
+    """
+    Multiplies each channel of an RGBA image by the matching value of
+    a setcoloreffect directive, in place.
+    """
+    img.paste(img.point(effect_table("color", effect, color_effect_table)))
+
+
 def apply_area_effect(img, effect):
-    data = img.load()
-    for x in range(img.size[0]):
-        for y in range(img.size[1]):
-            pixel = []
-            alpha = clamp(1.0-effect[3])
-            for c in range(3):
-                darkened = data[x,y][c] * alpha
-                tinted = darkened + (effect[c] * 255)
-                pixel.append(min(int(tinted), 255))
-            data[x,y] = tuple(pixel)
-                
-            
+    """
+    Darkens an RGBA image by the alpha of a seteffect directive and then
+    tints it by its colors, in place.  The image is left opaque.
+    """
+    img.paste(img.point(effect_table("area", effect, area_effect_table)))
+
+
 def add_composite(dest, blit):
     """
     Takes two PIL Image objects of the same size as arguments and adds
-    their color channels together, and returns a 3rd image.
+    their color channels together, and returns a 3rd image.  The color
+    channels of 'blit' are first multiplied by its alpha.  Without
+    numpy, that product may be rounded down by one.
     """
     assert dest.size == blit.size
-    bg_data = dest.load()
-    fg_data = blit.load()
-    out = Image.new('RGBA', blit.size)
-    out_data = out.load()
-
-    for x in range(blit.size[0]):
-        for y in range(blit.size[1]):
-            data = []
-            alpha = fg_data[x,y][3]/255.0
-            for c in range(3):
-                lhs = bg_data[x,y][c]
-                rhs = int(fg_data[x,y][c] * alpha)
-                data.append(min(lhs+rhs, 255))
-            data.append(1)
-            out_data[x,y] = tuple(data)
-    return out
+    if numpy is not None:
+        bg = numpy.asarray(dest)[:, :, :3]
+        fg = numpy.asarray(blit)
+        light = numpy.trunc(fg[:, :, :3] * (fg[:, :, 3:] / 255.0))
+        added = numpy.empty(fg.shape, numpy.uint8)
+        added[:, :, :3] = numpy.minimum(bg + light, 255)
+        added[:, :, 3] = 1
+        return Image.fromarray(added, "RGBA")
+
+    fg_alpha = blit.split()[3]
+    bands = [ImageChops.add(bg, ImageChops.multiply(fg, fg_alpha))
+             for bg, fg in zip(dest.split()[:3], blit.split()[:3])]
+    bands.append(Image.new("L", dest.size, 1))
+    return Image.merge("RGBA", bands)
+
+
+# Finished sprites, cut from their image and with their effect and zoom
+# applied, by (image path, clip, effect, zoom size).  Levels tend to
+# place many copies of the same few sprites.
+SPRITE_CACHE_BYTES = 64 * 1024 * 1024
+SPRITES = register_cache("sprite", LRUCache(
+    SPRITE_CACHE_BYTES, lambda sprite: sprite.size[0] * sprite.size[1] * 4))
+
+
+def load_sprite(actor):
+    """
+    Returns the image of an actor as it should be drawn.  The image is
+    shared with other actors, and must not be modified.
+    """
+    zoom_size = tuple(actor.zoom[2:4]) if actor.zoom else None
+    effect = tuple(actor.effect) if actor.effect else None
+    key = (actor.image, tuple(actor.clip), effect, zoom_size)
+    sprite = SPRITES.get(key)
+    if sprite is None:
+        img = Image.open(actor.image).convert("RGBA")
+        sprite = img.crop(make_box(*actor.clip))
+        if effect:
+            apply_effect(sprite, effect)
+        if zoom_size:
+            sprite = sprite.resize(zoom_size)
+        SPRITES[key] = sprite
+    return sprite
+
+
+def draw_sprite(out_img, sprite, x, y, light=False):
+    """
+    Composites the sprite onto out_img with its top left corner at x,y,
+    in place.  Parts of the sprite outside of out_img are skipped.
+    Light sprites are added to the image rather than drawn over it.
+    """
+    left, top = max(x, 0), max(y, 0)
+    right = min(x + sprite.size[0], out_img.size[0])
+    bottom = min(y + sprite.size[1], out_img.size[1])
+    if left >= right or top >= bottom:
+        return
+    source = (left - x, top - y, right - x, bottom - y)
+    if light:
+        box = (left, top, right, bottom)
+        visible = sprite.crop(source)
+        out_img.paste(add_composite(out_img.crop(box), visible), box)
+    else:
+        out_img.alpha_composite(sprite, (left, top), source)
 
 
 def add_actors(out_img, actors):
     for actor in actors:
         if actor.image:
-            img_path = actor.image
-            img = Image.open(img_path).convert("RGBA")
-                                
-            shape = actor.clip
-            sprite = img.crop(make_box(*shape))
-
-            if actor.effect:
-                apply_effect(sprite, actor.effect)
-
-            x = actor.x * TILE_SIZE
-            y = actor.y * TILE_SIZE
-            paste_shape = [x, y] + list(sprite.size)
-
+            sprite = load_sprite(actor)
             if actor.zoom:
-                new_x, new_y, new_w, new_h, scale = actor.zoom
-                sprite = sprite.resize([new_w, new_h])
-                x = new_x * TILE_SIZE
-                y = new_y * TILE_SIZE
-                paste_shape = [x, y] + list(sprite.size)
-            
-            paste_box = make_box(*paste_shape)
-            bg = out_img.crop(paste_box)
-            mixed = None
-            if actor.effect:
-                mixed = add_composite(bg, sprite)
+                x, y = actor.zoom[:2]
             else:
-                mixed = Image.alpha_composite(bg, sprite)
-            out_img.paste(mixed, paste_box)
+                x, y = actor.x, actor.y
+            left, top = make_box(x * TILE_SIZE, y * TILE_SIZE)[:2]
+            draw_sprite(out_img, sprite, left, top, bool(actor.effect))
 
 
-def convert_to_png(level_path, tiles_path, sprites_path, out_path):
+def convert_to_png(level_path, tiles_path, sprites_path, out_path,
+                   paletted=False):
+    """
+    Draws a level and saves it as a png image.  If paletted is True,
+    levels that only show their board are saved as palette images,
+    which are smaller and faster to write.  Levels with actors or area
+    effects are always saved as RGB images.
+    """
     setup_paths(sprites_path, out_path)
 
     level = load_level(level_path)
-    tiles = tile_segments(tiles_path)
-    out_img = generate_map(level.board, tiles)
-    layers = {
-        "normal" : [],
-        "light" : [],
-    }
-    for actor in level.actors:
-        if actor.layer < 2:
-            layers["normal"].append(actor)
-        else:
-            layers["light"].append(actor)
-
-    for baddy in level.baddies:
-        actor = baddy.make_fake_actor()
-        layers["normal"].append(actor)
-    
-    add_actors(out_img, layers["normal"])
+    tileset = load_tileset(tiles_path)
+    queue = level.render_queue()
+    if tileset.can_index(level.board.tiles) and not level.effects and \
+       not any(actor.image for actor in queue):
+        # nothing is drawn over the board, so its pixels need not be
+        # expanded to RGBA
+        out_img = generate_map(level.board, tileset, indexed=True)
+        if not paletted:
+            out_img = out_img.convert("RGB")
+        out_img.save(out_path)
+        return
+
+    out_img = generate_map(level.board, tileset)
+    add_actors(out_img, queue.ordered(high=2))
     if len(level.effects) == 1:
         apply_area_effect(out_img, level.effects[0])
     elif len(level.effects) > 1:
         print "multiple area lighting effects detected"
     
     # TODO apply area lighting here
-    add_actors(out_img, layers["light"])
+    add_actors(out_img, queue.ordered(low=2))
     out_img.convert("RGB").save(out_path)
 
             
 if __name__ == "__main__":
-    if len(sys.argv) == 1:
+    paletted = "--paletted" in sys.argv
+    args = [arg for arg in sys.argv if arg != "--paletted"]
+    if len(args) == 1:
         print "First argument must be a level file."
         exit()
 
-    level_path = sys.argv[1]
+    level_path = args[1]
     tiles_path = os.path.join("sprites", "pics1.png")
-    if len(sys.argv) >= 3:
-        tiles_path = sys.argv[2]
+    if len(args) >= 3:
+        tiles_path = args[2]
 
     level_name = os.path.split(level_path)[-1]
-    if len(sys.argv) >= 4:
-        level_name = sys.argv[3]
+    if len(args) >= 4:
+        level_name = args[3]
     out_path = os.path.join("out", level_name + ".png")
 
     for path in [level_path, tiles_path]:
@@ -192,4 +266,4 @@ if __name__ == "__main__":
             print "No such file: " + path
             exit()
 
-    convert_to_png(level_path, tiles_path, "sprites", out_path)
+    convert_to_png(level_path, tiles_path, "sprites", out_path, paletted)
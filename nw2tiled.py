@@ -23,7 +23,7 @@ from xml.dom import minidom
 from PIL import Image
 
 from util import load_level
-from parser_common import setup_paths, relative_img_path
+from parser_common import setup_paths, relative_img_path, TILE_COORDS
 
 
 def pretty_print(elem):
@@ -34,11 +34,10 @@ def pretty_print(elem):
 
 def encode_as_csv(level):
     data = []
-    for y in range(64):
-        for x in range(64):
-            tile_x, tile_y = level.board[x][y]
-            tiled_index = (tile_x + (128 * tile_y)) + 1
-            data.append(str(tiled_index))
+    for tile in level.board.tiles:
+        tile_x, tile_y = TILE_COORDS[tile]
+        tiled_index = (tile_x + (128 * tile_y)) + 1
+        data.append(str(tiled_index))
         
     return ",".join(data)
 
@@ -127,7 +126,8 @@ def encode_as_tmx(level, tileset_path):
     npc_layer = SubElement(root, 'objectgroup')
     npc_layer.attrib['name'] = "npcs"
     obj_id = 0
-    for actor in level.actors:
+    # baddies are left out, as tile objects can't show part of an image
+    for actor in level.render_queue(baddies=False):
         if not actor.image:
             continue
         obj_id += 1
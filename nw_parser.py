@@ -19,117 +19,187 @@ import os
 import sys
 import string
 from PIL import Image
-from parser_common import LevelParser, UnknownFileHeader
+from parser_common import LevelParser, UnknownFileHeader, TILE_COORDS
+from parser_common import ENTITY_TYPES, BoardRow, Sign, Actor, Link, Baddy
+from parser_common import TreasureBox
 
 
 BASE64 = string.ascii_uppercase + string.ascii_lowercase + string.digits + "+/"
 
 
+# Maps every two character base64 tile code to its tile index.
+TILE_CODES = dict((BASE64[index / 64] + BASE64[index % 64], index)
+                  for index in range(4096))
+
+
+def decode_board_row(data, run):
+    """
+    Decodes the first 'run' tiles of the base64 data from a BOARD line,
+    and returns a list of their tile indices.
+    """
+    return [TILE_CODES[data[i:i+2]] for i in xrange(0, run * 2, 2)]
+
+
+# Patterns for entities that are described by a single line.
+LINE_PATTERNS = {
+    "BOARD" : re.compile(r'BOARD (\d+) (\d+) (\d+) (\d+) ([{0}]+)'.format(BASE64)),
+    "LINK" : re.compile(r'LINK (.+) (\d+) (\d+) (\d+) (\d+) ([^\s]+) ([^\s]+)$'),
+    "CHEST" : re.compile(r'CHEST (-?\d+) (-?\d+) (.*) (-?\d+)$'),
+}
+
+
+# Patterns for the first line of entities that span multiple lines.
+BLOCK_PATTERNS = {
+    "NPC" : re.compile(r'NPC ([^\s]+) (-?\d+) (-?\d+)$'),
+    "SIGN" : re.compile(r'SIGN (-?\d+) (-?\d+)$'),
+    "BADDY" : re.compile(r'BADDY (-?\d+) (-?\d+) (\d+)$'),
+}
+
+
+def read_lines(reader):
+    """
+    Yields the lines of a file one at a time without their line
+    endings, where lines end in either a newline or a carriage return
+    and newline.
+    """
+    for line in reader:
+        if line.endswith("\r\n"):
+            yield line[:-2]
+        elif line.endswith("\n"):
+            yield line[:-1]
+        else:
+            yield line
+
+
+def tokenize(lines):
+    """
+    Walks over the lines of a .nw file once, dispatching on the leading
+    keyword of each line, and yields a (keyword, params) tuple for each
+    board row and entity found.  The params are the strings captured
+    from the entity's header, followed by the text of its body for
+    NPCs and signs, or its three messages for baddies.
+
+    NPC and sign bodies run up to the first line ending in NPCEND or
+    SIGNEND, and their text starts with the newline after the header.
+    A block that is never closed is skipped, and scanning resumes with
+    the line after its header.
+    """
+    lines = iter(lines)
+    pushed = []
+    # blocks that reached the end of the file without being closed,
+    # after which no later block of the same kind can be closed either
+    unclosed = set()
+
+    def read():
+        return pushed.pop() if pushed else next(lines, None)
+
+    while True:
+        line = read()
+        if line is None:
+            return
+
+        keyword = line.split(" ", 1)[0]
+        if LINE_PATTERNS.has_key(keyword):
+            match = LINE_PATTERNS[keyword].match(line)
+            if match:
+                yield keyword, match.groups()
+            continue
+
+        if not BLOCK_PATTERNS.has_key(keyword):
+            continue
+        match = BLOCK_PATTERNS[keyword].match(line)
+        if not match or keyword in unclosed:
+            continue
+
+        if keyword == "BADDY":
+            messages = []
+            while len(messages) < 4:
+                line = read()
+                if line is None:
+                    break
+                messages.append(line)
+            if len(messages) == 4 and messages[3] == "BADDYEND":
+                yield keyword, match.groups() + tuple(messages[:3])
+            else:
+                pushed.extend(reversed(messages))
+            continue
+
+        terminator = keyword + "END"
+        body = []
+        line = read()
+        while line is not None and not line.endswith(terminator):
+            body.append(line)
+            line = read()
+        if line is None:
+            unclosed.add(keyword)
+            pushed.extend(reversed(body))
+            continue
+        body.append(line[:-len(terminator)])
+        yield keyword, match.groups() + ("\n" + "\n".join(body),)
+
+
 class DotNWParser(LevelParser):
     """
     This class takes a path to a .nw encoded file, decodes it, and
     provides a means of easily accessing the contained data.
     """
 
+    HEADERS = ("GLEVNW01",)
+    EXTENSIONS = (".nw",)
+
     def file_version(self):
         if not self.header == "GLEVNW01":
             raise UnknownFileHeader("Unknown header: %s" % self.header)
         return 1
 
 
-    def parse(self, text_only = False):
-        with open(self._uri, "r") as reader:
-            raw_data = reader.read().replace("\r\n", "\n")
-            lines = raw_data.split("\n")
-
-        pattern = r'BOARD (\d+) (\d+) (\d+) (\d+) ([{0}]+)'.format(BASE64)
-        for line in lines:
-            match = re.match(pattern, line)
-            if match:
-                x_start, y_start, run, layer, data = match.groups()
-                y = int(y_start)
-                for i in range(int(run)*2)[::2]:
-                    x = i/2
-                    encoded = data[i:i+2]
-                    self.board[x][y] = self.decode_tile(encoded)
-        if not text_only:
-            self.find_npcs(raw_data)
-            self.find_links(raw_data)
-            self.find_baddies(raw_data)
-            self.find_treasures(raw_data)
-        self.find_signs(raw_data)
+    def iter_entities(self, kinds=ENTITY_TYPES, fastmode=False):
+        record_types = {
+            "BOARD" : BoardRow,
+            "SIGN" : Sign,
+            "NPC" : Actor,
+            "LINK" : Link,
+            "BADDY" : Baddy,
+            "CHEST" : TreasureBox,
+        }
+        with self.open_level() as reader:
+            for keyword, params in tokenize(read_lines(reader)):
+                if not issubclass(record_types[keyword], kinds):
+                    continue
+
+                if keyword == "BOARD":
+                    x_start, y_start, run, layer, data = params
+                    tiles = decode_board_row(data, int(run))
+                    yield BoardRow(int(y_start), tiles)
+
+                elif keyword == "SIGN":
+                    x, y, text = params
+                    yield Sign(int(x), int(y), text)
+
+                elif keyword == "NPC":
+                    img, x, y, src = params
+                    img = img if img != '-' else None
+                    yield Actor(int(x), int(y), img, src.strip(), fastmode)
+
+                elif keyword == "LINK":
+                    yield Link(*params)
+
+                elif keyword == "BADDY":
+                    x, y, kind = map(int, params[:3])
+                    yield Baddy(x, y, kind, params[3:])
+
+                elif keyword == "CHEST":
+                    x, y, item, sign = params
+                    yield TreasureBox(int(x), int(y), item, int(sign))
 
     
     def decode_tile(self, aa):
         """
-        This method is called by parse_tile, and does not need to be
-        called directly.  This function takes a pair of characters
-        'XX' which represents a number in base64, and determines the
-        x,y coordinate encoded in that number.
+        This function takes a pair of characters 'XX' which represents
+        a number in base64, and determines the x,y coordinate encoded in
+        that number.  Whole BOARD rows are decoded in bulk by
+        decode_board_row instead.
 
-        The return value is a dictionary that describes the tile.
+        The return value is the x,y coordinate of the tile in pics1.png.
         """
-        lhs = BASE64.index(aa[0])*64
-        rhs = BASE64.index(aa[1])
-        di = lhs + rhs
-        tx = di % 16
-        ty = di / 16
-        bx = ty / 32 * 16 + tx
-        by = ty % 32 
-        # tile = {
-        #     "code" : aa,
-        #     "index" : di,
-        #     "__t_xy" : (tx, ty),
-        #     "sprite" : (bx, by),
-        # }
-        return (bx, by)
-
-    
-    def find_npcs(self, raw_data):
-        pattern = r'^NPC ([^\s]+) (-?\d+) (-?\d+)$(.+?)NPCEND$'
-        flags = re.DOTALL | re.MULTILINE
-        npcs = re.findall(pattern, raw_data, flags)
-        for npc in npcs:
-            x, y = int(npc[1]), int(npc[2])
-            img = npc[0] if npc[0] != '-' else None
-            src = npc[3].strip()
-            self.add_actor(x, y, img, src)
-
-
-    def find_links(self, raw_data):
-        pattern = r'^LINK (.+) (\d+) (\d+) (\d+) (\d+) ([^\s]+) ([^\s]+)$'
-        flags = re.MULTILINE
-        links = re.findall(pattern, raw_data, flags)
-        for link_params in links:
-            self.add_link(*link_params)
-
-
-    def find_baddies(self, raw_data):
-        pattern = r'^BADDY (-?\d+) (-?\d+) (\d+)\n([^\n]*)\n([^\n]*)\n([^\n]*)\nBADDYEND$'
-        flags = re.MULTILINE
-        baddies = re.findall(pattern, raw_data, flags)
-        for baddy in baddies:
-            x, y, kind = map(int, baddy[:3])
-            messages = baddy[3:]
-            self.add_baddy(x, y, kind, messages)
-
-
-    def find_treasures(self, raw_data):
-        pattern=r'^CHEST (-?\d+) (-?\d+) (.*) (-?\d+)$'
-        flags = re.MULTILINE
-        treasures = re.findall(pattern, raw_data, flags)
-        for treasure in treasures:
-            x, y = map(int, treasure[:2])
-            item = treasure[2]
-            sign = int(treasure[3])
-            self.add_treasure(x, y, item, sign)
-        
-
-    def find_signs(self, raw_data):
-        pattern = r'^SIGN (-?\d+) (-?\d+)$(.+?)SIGNEND$'
-        flags = re.DOTALL | re.MULTILINE
-        signs = re.findall(pattern, raw_data, flags)
-        for sign in signs:
-            x, y = int(sign[0]), int(sign[1])
-            text = sign[2]
-            self.add_sign(x, y, text)
+        return TILE_COORDS[TILE_CODES[aa]]
@@ -17,29 +17,68 @@
 
 import os
 import re
-import hashlib
-import itertools
+import sys
+from array import array
+from cStringIO import StringIO
+from contextlib import closing
 from PIL import Image
-from script_munger import find_immediates
+from script_munger import find_immediates, find_directives, analyze_script
+from script_munger import evaluate, ExpressionError, IMMEDIATES_VERSION
+from fingerprint import level_fingerprints, DEFAULT_DIGEST
+from caching import cache_file, load_cache, save_cache
+from caching import FileDataCache, register_cache
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 TILE_SIZE = 16
 SPRITES_PATH = "sprites"
 SPRITES_RELATIVE = SPRITES_PATH
 OUTPUT_PATH = os.path.abspath('.')
+SPRITES_CASE_SENSITIVE = True
+
+
+def tile_coordinates(index):
+    """
+    Converts a tile index, as stored in a level's board data, into the
+    x,y coordinate of the tile within pics1.png.  See
+    nw_file_specification.org for how this formula was derived.
+    """
+    tx = index % 16
+    ty = index / 16
+    bx = ty / 32 * 16 + tx
+    by = ty % 32
+    return (bx, by)
+
+
+# Precomputed coordinates for every possible tile index.
+TILE_COORDS = tuple(tile_coordinates(index) for index in range(4096))
 
 
-def setup_paths(sprites_path, output_path):
+# Maps the coordinate of every tile in pics1.png back to its index.
+TILE_INDICES = dict((coord, index) for index, coord in enumerate(TILE_COORDS))
+
+
+def setup_paths(sprites_path, output_path, case_sensitive=True):
     global SPRITES_RELATIVE
     global SPRITES_PATH
     global OUTPUT_PATH
+    global SPRITES_CASE_SENSITIVE
     OUTPUT_PATH = os.path.abspath(output_path) # path to output file
     SPRITES_PATH = os.path.abspath(sprites_path)
+    SPRITES_CASE_SENSITIVE = case_sensitive
     output_dir = os.path.split(OUTPUT_PATH)[0] # directory of output file
     assert os.path.isdir(SPRITES_PATH)
     assert os.path.isdir(output_dir)
     SPRITES_RELATIVE = os.path.relpath(SPRITES_PATH, output_dir)
 
+    # the sprites may have changed since the last conversion
+    for index in SPRITE_INDEXES.values():
+        index.checked = False
+
 
 def relative_img_path(long_path):
     assert os.path.isfile(long_path)
@@ -47,21 +86,177 @@ def relative_img_path(long_path):
         SPRITES_RELATIVE, os.path.relpath(long_path, SPRITES_PATH))
 
 
+class SpriteIndex(object):
+    """
+    Maps the name of every file under a sprites directory to its path,
+    along with the order in which a recursive search would have found
+    it.  The modification time and size of every directory walked is
+    recorded, so that the index can tell when it is out of date.  If
+    the sprites directory does not exist, that is recorded instead.
+    """
+    VERSION = 2
+
+    def __init__(self, root):
+        self.root = root
+        self.version = self.VERSION
+        self.dirs = {}
+        self.names = {}
+        self.folded = {}
+        self.checked = True
+
+    def build(self):
+        found = 0
+        # replaced by the stat of the root when it is walked
+        self.dirs[self.root] = None
+        tree = os.walk(self.root, True, None, True)
+        for root, dirnames, filenames in tree:
+            stat = os.stat(root)
+            self.dirs[root] = (stat.st_mtime, stat.st_size)
+            for filename in filenames:
+                match = (found, os.path.join(root, filename))
+                self.names.setdefault(filename, match)
+                self.folded.setdefault(filename.lower(), match)
+                found += 1
+        return self
+
+    def is_current(self):
+        """
+        Returns False if any of the directories in the index have been
+        changed or removed since it was built, or if the sprites
+        directory was missing and has since been created.
+        """
+        if self.version != self.VERSION:
+            return False
+        for path, recorded in self.dirs.iteritems():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                if recorded is None:
+                    continue
+                return False
+            if (stat.st_mtime, stat.st_size) != recorded:
+                return False
+        return True
+
+    def find(self, stem, extensions, case_sensitive=True):
+        """
+        Returns the path of the first file found named stem.ext for any
+        of the given extensions, or None.
+        """
+        names = self.names if case_sensitive else self.folded
+        found = None
+        for ext in extensions:
+            name = stem + "." + ext
+            match = names.get(name if case_sensitive else name.lower())
+            if match and (found is None or match < found):
+                found = match
+        return found[1] if found else None
+
+
+# Sprite indexes loaded by this process, by the absolute path of the
+# sprites directory.
+SPRITE_INDEXES = {}
+
+
+def sprite_index(root):
+    """
+    Returns the SpriteIndex for the given sprites directory.  The index
+    is loaded from the cache if it is still current, and otherwise is
+    rebuilt and saved for other processes to use.
+    """
+    key = os.path.abspath(root)
+    index = SPRITE_INDEXES.get(key)
+    if index is not None and index.checked:
+        return index
+
+    path = cache_file("sprites", key)
+    if index is None:
+        index = load_cache(path)
+    if index is None or index.root != root or not index.is_current():
+        index = SpriteIndex(root).build()
+        save_cache(path, index)
+    index.checked = True
+    SPRITE_INDEXES[key] = index
+    return index
+
+
 def file_search(name, extensions):
     """
-    This method recursively searches the "sprites" directory for the
-    first image file that matches img_name, and returns its path.
+    This method searches the "sprites" directory for the first image
+    file that matches img_name, and returns its path.  See SpriteIndex.
 
     This is used for looking up the sprite needed to draw NPCs.
     """
     name = ".".join(name.split(".")[:-1])
-    tree = os.walk(SPRITES_PATH, True, None, True)
-    for root, dirnames, filenames in tree:
-        for filename in filenames:
-            for ext in extensions:
-                if filename == name + "." + ext:
-                    return os.path.join(root, filename)
-    return None
+    index = sprite_index(SPRITES_PATH)
+    return index.find(name, extensions, SPRITES_CASE_SENSITIVE)
+
+
+# The width, height, and mode of images, by path.  See image_info.
+IMAGE_INFO = register_cache(
+    "image info", FileDataCache("images", "image_info"))
+
+
+def probe_image(img_path):
+    try:
+        with open(img_path, "rb") as img_file:
+            img = Image.open(img_file)
+            return (img.size[0], img.size[1], img.mode)
+    except Exception:
+        return None
+
+
+def image_info(img_path):
+    """
+    Returns the (width, height, mode) of an image, or None if it can't
+    be opened as one.  Only the image header is read, and the result
+    is kept in a cache shared with other processes, so that the same
+    image is only probed again if the file changes.
+    """
+    return IMAGE_INFO.get(img_path, probe_image)
+
+
+# The immediate commands of joined scripts, and the names of the
+# scripts they join in turn, by path.  See joined_commands.
+JOINED_SCRIPTS = register_cache("joined script", FileDataCache(
+    "scripts", repr(("joined_scripts", IMMEDIATES_VERSION))))
+
+
+def reduce_script(script_path):
+    with open(script_path, "r") as script_file:
+        commands = find_immediates(script_file.read())
+    joins = [command[5:] for command in commands if command.startswith("join ")]
+    return (commands, joins)
+
+
+def joined_commands(name, joining=()):
+    """
+    Returns the immediate commands of the script named by a "join
+    name;" command, followed by those of any scripts it joins in turn,
+    or None if the script can't be found.  The commands of each script
+    are cached, so that a script joined by many NPCs is only read and
+    reduced once.  'joining' is the chain of scripts already being
+    joined, which are skipped to avoid joining in a loop.
+    """
+    path = file_search(name + ".txt", ["txt"])
+    if not path:
+        return None
+    if path in joining:
+        print "Skipping cyclic join: %s.txt" % name
+        return []
+    reduced = JOINED_SCRIPTS.get(path, reduce_script)
+    if reduced is None:
+        return None
+
+    commands, joins = reduced
+    commands = list(commands)
+    for joined in joins:
+        nested = joined_commands(joined, joining + (path,))
+        if nested is None:
+            print "Can't find script: %s.txt" % joined
+        else:
+            commands += nested
+    return commands
 
 
 def img_search(img_name):
@@ -76,15 +271,24 @@ class UnknownFileHeader(Exception):
     pass
 
 
+class MalformedLevel(Exception):
+    pass
+
+
 
 
 class Actor(object):
     """
     Represents an interactible game object.
     """
+    # Entities use slots rather than a __dict__, as corpus tools may
+    # keep thousands of levels' worth of them in memory at once.
+    __slots__ = ("src", "image", "x", "y", "clip", "zoom", "effect", "layer",
+                 "_inputs")
     
     def __init__(self, x, y, image, src, fastmode):
-        self.original_inputs = [x, y, image, src]
+        # the position and image name before munge
+        self._inputs = (x, y, image)
         self.src = src
         self.image = None
         self.x = x
@@ -100,22 +304,34 @@ class Actor(object):
         if image:
             img_path = img_search(image)
             if img_path:
-                try:
-                    img = Image.open(img_path)
+                info = image_info(img_path)
+                if info:
                     self.image = img_path
-                    self.clip = [0, 0, img.size[0], img.size[1]]
-                except:
+                    self.clip = [0, 0, info[0], info[1]]
+                else:
                     print "Cannot find file: %s" % img_path
         self.munge()
 
 
-    def __move(self, axis, match):
+    @property
+    def original_inputs(self):
+        """
+        The arguments this Actor was created from, for fingerprinting.
+        """
+        x, y, image = self._inputs
+        return [x, y, image, self.src]
+
+
+    def __move(self, axis, operator, value):
         """
         Move the actor.
         """
-        operator, value = match.groups()
         old_value = self.__getattribute__(axis)
-        value = float(eval(value.replace(axis, str(old_value))))
+        try:
+            value = float(evaluate(value, {axis : old_value}))
+        except (ExpressionError, ArithmeticError):
+            print "error parsing:", value
+            return
         if (operator == "="):
             self.__setattr__(axis, value)
         elif (operator == "+="):
@@ -131,96 +347,81 @@ class Actor(object):
         Search through the provided script file and attempt to determine
         parameters for rendering this Actor.
         """
-        
-        def reduce_src(src):
-            tokens = [token + ";" for token in find_immediates(src)]
-            return "\n".join(tokens)
-        
-        init_block = reduce_src(self.src)
-
-        join_pattern = r'^join (.*?);'
-        join_matches = re.findall(join_pattern, init_block, re.MULTILINE)
-        if join_matches:
-            for match in join_matches:
-                path = file_search(match + ".txt", ["txt"])
-                if path:
-                    raw = open(path, 'r').read()
-                    init_block += '\n' + reduce_src(raw);
+        directives = analyze_script(self.src)[1]
+        if directives.joins:
+            directives = directives.copy()
+            for match in list(directives.joins):
+                commands = joined_commands(match)
+                if commands is not None:
+                    find_directives(commands, directives)
                 else:
                     print "Can't find script: %s.txt" % match
-        
-        offset_patterns = {}
-        offset_patterns['x'] = [
-            r'^ *x ?(=) ?((?:x? ?[\d/*+\-. ]+)|(?:[\d/*+\-. ]+ ?x?)) ?;',
-            r'^ *x ?(\+=|\-=) ?([\d/*+\-. ]+) ?;',
-        ]
-        offset_patterns['y'] = [
-            regex.replace('x', 'y') for regex in offset_patterns['x']]
-        flags = re.DOTALL | re.MULTILINE
-
-        moved = False
-        for axis, patterns in offset_patterns.items():
-            for refex in patterns:
-                found = re.search(regex, init_block, flags)
-                if found:
-                    self.__move(axis, found)
-                moved = True
-                break
-
-        if init_block.count('hide;'):
-            self.image = None
-
-        if init_block.count("setimgpart") or init_block.count("setgifpart"):
-            pattern = r'set(?:img|gif)part ([^\s]+?) ?, ?([\d/*+-]+) ??, ?([\d/*+-]+) ??, ?([\d/*+-]+) ??, ?([\d/*+-]+) ?;'
-            found = re.findall(pattern, init_block)
-            if found:
-                self.image = img_search(found[0][0])
-                self.clip = map(lambda x: eval(x), found[0][1:])
+        self.apply_directives(directives)
 
-        if init_block.count("drawaslight;"):
-            self.layer = 2
 
-        elif init_block.count("drawunderplayer;"):
-            self.layer = -1
+    def apply_directives(self, directives):
+        """
+        Applies the directives found by script_munger.find_directives
+        to this Actor.
+        """
+        for axis in ('x', 'y'):
+            if directives.moves.has_key(axis):
+                self.__move(axis, *directives.moves[axis])
 
-        elif init_block.count("drawoverplayer;"):
-            self.layer = 1
-        
-        if init_block.count("setcoloreffect"):
-            pattern = r'setcoloreffect ?([\d/*.+-]+) ?, ?([\d/*.+-]+)?, ?([\d/*.+-]+)?, ?([\d/*.+-]+);'
-            found = re.findall(pattern, init_block)
-            if found:
-                try:
-                    self.effect = map(lambda x: eval(x) if len(x) > 0 else 0.0, found[0])
-                except:
-                    print "error parsing:", found[0]
-                    self.image = None
+        if directives.hide:
+            self.image = None
 
-        if init_block.count("setzoomeffect"):
-            pattern = r'setzoomeffect ?([\d/*.+-]+) ?;'
-            found = re.findall(pattern, init_block)
-            if found:
-                zoom = float(eval(found[0]))
-                old_width = self.clip[2]
-                new_width = int(old_width * zoom)
-                old_height = self.clip[3]
-                new_height = int(old_height * zoom)
-                new_x = self.x + (((new_width - old_width) / 2.0) * -1) / TILE_SIZE
-                new_y = self.y + (((new_height - old_height) / 2.0) * -1) / TILE_SIZE
-                self.zoom = [new_x, new_y, new_width, new_height, zoom]
+        if directives.image_part:
+            image, clip = directives.image_part
+            try:
+                clip = map(evaluate, clip)
+            except (ExpressionError, ArithmeticError):
+                print "error parsing:", directives.image_part
+            else:
+                self.image = img_search(image)
+                self.clip = clip
+
+        if directives.layer is not None:
+            self.layer = directives.layer
+
+        if directives.effect:
+            try:
+                self.effect = map(lambda x: evaluate(x) if len(x) > 0 else 0.0, directives.effect)
+            except:
+                print "error parsing:", directives.effect
+                self.image = None
+
+        if directives.zoom:
+            try:
+                zoom = float(evaluate(directives.zoom))
+            except (ExpressionError, ArithmeticError):
+                print "error parsing:", directives.zoom
+                return
+            old_width = self.clip[2]
+            new_width = int(old_width * zoom)
+            old_height = self.clip[3]
+            new_height = int(old_height * zoom)
+            new_x = self.x + (((new_width - old_width) / 2.0) * -1) / TILE_SIZE
+            new_y = self.y + (((new_height - old_height) / 2.0) * -1) / TILE_SIZE
+            self.zoom = [new_x, new_y, new_width, new_height, zoom]
 
 
 class Baddy(object):
+    __slots__ = ("x", "y", "kind", "messages")
+
     def __init__(self, x, y, kind, messages):
-        self.original_input = [x, y, kind, messages]
         self.x = x
         self.y = y
         self.kind = kind
         assert(len(messages) == 3)
         self.messages = messages
 
+    @property
+    def original_inputs(self):
+        return [self.x, self.y, self.kind, self.messages]
+
     def make_fake_actor(self):
-        fake = Actor(self.x - 0.5, self.y - 1, 'opps.png', '')
+        fake = Actor(self.x - 0.5, self.y - 1, 'opps.png', '', False)
         
         if self.kind in [0, 1, 2]:
             # grey, blue, red
@@ -271,6 +472,8 @@ class Baddy(object):
 
 
 class TreasureBox(object):
+    __slots__ = ("x", "y", "kind", "sign_index")
+
     def __init__(self, x, y, kind, sign_index):
         self.x = x
         self.y = y
@@ -281,15 +484,22 @@ class TreasureBox(object):
 
 
 class Sign(object):
+    __slots__ = ("text", "area")
+
     def __init__(self, x, y, text):
-        self.original_inputs = [x, y, text]
         self.text = text
         self.area = (x, y, 2, 1)
 
+    @property
+    def original_inputs(self):
+        return [self.area[0], self.area[1], self.text]
+
 
 
 
 class Link(object):
+    __slots__ = ("target", "area", "dest")
+
     def __init__(self, target, x, y, w, h, new_x, new_y):
         self.target = target
         self.area = map(int, (x, y, w, h))
@@ -298,18 +508,317 @@ class Link(object):
 
 
 
+class BoardRow(object):
+    """
+    A row of tiles from a level's board, starting from x = 0.  The
+    tiles are tile indices, see TILE_COORDS.
+    """
+    __slots__ = ("y", "tiles")
+
+    def __init__(self, y, tiles):
+        self.y = y
+        self.tiles = tiles
+
+
+
+
+class BoardColumn(object):
+    """
+    A single column of a Board, so that board[x][y] continues to
+    return the x,y coordinate of the tile within pics1.png.
+    """
+    __slots__ = ("board", "x")
+
+    def __init__(self, board, x):
+        self.board = board
+        self.x = x
+
+    def __len__(self):
+        return Board.HEIGHT
+
+    def __getitem__(self, y):
+        return TILE_COORDS[self.board.tiles[self.board.cell(self.x, y)]]
+
+    def __setitem__(self, y, coord):
+        self.board.tiles[self.board.cell(self.x, y)] = TILE_INDICES[coord]
+
+    def __iter__(self):
+        return (TILE_COORDS[tile] for tile in self.board.column(self.x))
+
+
+
+
+class Board(object):
+    """
+    The tiles of a level, stored as a flat array of 64*64 tile indices
+    in row major order.  Indexing the board as board[x][y] returns the
+    tile's x,y coordinate within pics1.png like the nested lists used
+    previously, but bulk operations should use the tiles array, the
+    row and column accessors, or as_numpy instead.
+    """
+    WIDTH = 64
+    HEIGHT = 64
+
+    def __init__(self, tiles=None):
+        if tiles is None:
+            self.tiles = array('H', [0]) * (self.WIDTH * self.HEIGHT)
+        else:
+            self.tiles = array('H', tiles)
+            assert len(self.tiles) == self.WIDTH * self.HEIGHT
+
+    def cell(self, x, y):
+        """
+        Returns the position of the tile at x,y in the tiles array.
+        """
+        if not (0 <= x < self.WIDTH and 0 <= y < self.HEIGHT):
+            raise IndexError("Tile out of range: %s, %s" % (x, y))
+        return y * self.WIDTH + x
+
+    def __len__(self):
+        return self.WIDTH
+
+    def __getitem__(self, x):
+        if not 0 <= x < self.WIDTH:
+            raise IndexError("Column out of range: %s" % x)
+        return BoardColumn(self, x)
+
+    def __iter__(self):
+        return (BoardColumn(self, x) for x in range(self.WIDTH))
+
+    def row(self, y):
+        """
+        Returns the tile indices of the given row as an array.
+        """
+        start = self.cell(0, y)
+        return self.tiles[start:start + self.WIDTH]
+
+    def column(self, x):
+        """
+        Returns the tile indices of the given column as an array.
+        """
+        return self.tiles[self.cell(x, 0)::self.WIDTH]
+
+    def set_row(self, y, tiles, x=0):
+        """
+        Overwrites the tiles of the given row, starting from x.
+        """
+        start = self.cell(x, y)
+        if x + len(tiles) > self.WIDTH:
+            raise IndexError("Row too long: %s tiles from %s" % (len(tiles), x))
+        self.tiles[start:start + len(tiles)] = array('H', tiles)
+
+    def tostring(self):
+        """
+        Returns the tile indices as little endian bytes, for hashing
+        or saving.
+        """
+        if sys.byteorder == "little":
+            return self.tiles.tostring()
+        swapped = array('H', self.tiles)
+        swapped.byteswap()
+        return swapped.tostring()
+
+    def as_numpy(self):
+        """
+        Returns a 64x64 numpy view of the tile indices, indexed as
+        [y, x].  Writes to the view change the board.  Returns None if
+        numpy is not available.
+        """
+        if numpy is None:
+            return None
+        view = numpy.frombuffer(self.tiles, numpy.uint16)
+        return view.reshape((self.HEIGHT, self.WIDTH))
+
+
+
+
+def depth_key(drawable):
+    """
+    Returns the key that actors are sorted by for drawing: their layer,
+    then the y coordinate of their base, then their x coordinate.
+    """
+    if drawable.zoom:
+        x, y, width, height = drawable.zoom[:4]
+    else:
+        x, y, height = drawable.x, drawable.y, drawable.clip[3]
+    return (drawable.layer, y + (height / TILE_SIZE), x)
+
+
+
+
+class RenderQueue(object):
+    """
+    Actors, and anything else with the same position and clip fields,
+    in the order they should be drawn.  The sort key of each drawable
+    is computed once when it is added, and each layer is only sorted
+    when it is next drawn after drawables were added to it.
+    """
+    def __init__(self, drawables=()):
+        self.queued = {} # layer -> [(sort key, insertion order, drawable)]
+        self.unsorted = set()
+        self.count = 0
+        for drawable in drawables:
+            self.add(drawable)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return self.ordered()
+
+    def add(self, drawable):
+        key = depth_key(drawable)
+        self.queued.setdefault(key[0], []).append((key, self.count, drawable))
+        self.unsorted.add(key[0])
+        self.count += 1
+
+    def copy(self):
+        """
+        Returns a new queue of the same drawables, which reuses their
+        sort keys and the order of the layers that are already sorted.
+        """
+        copied = RenderQueue()
+        copied.queued = dict((layer, list(queued))
+                             for layer, queued in self.queued.items())
+        copied.unsorted = set(self.unsorted)
+        copied.count = self.count
+        return copied
+
+    def layers(self):
+        """
+        Returns the layers that have drawables, from the bottom up.
+        """
+        return sorted(self.queued.keys())
+
+    def ordered(self, low=None, high=None):
+        """
+        Yields the drawables in drawing order, from only the layers from
+        'low' up to but not including 'high' if either is given.
+        Drawables that sort the same are drawn in the order they were
+        added.
+        """
+        for layer in self.layers():
+            if (low is not None and layer < low) or \
+               (high is not None and layer >= high):
+                continue
+            queued = self.queued[layer]
+            if layer in self.unsorted:
+                queued.sort()
+                self.unsorted.discard(layer)
+            for entry in queued:
+                yield entry[2]
+
+
+
+
+# Every kind of record yielded by LevelParser.iter_entities.
+ENTITY_TYPES = (BoardRow, Link, Sign, Actor, Baddy, TreasureBox)
+
+
+# The LevelParser attribute each kind of entity is collected in.
+ENTITY_LISTS = {
+    Link : "links",
+    Sign : "signs",
+    Actor : "actors",
+    Baddy : "baddies",
+    TreasureBox : "treasures",
+}
+
+
+# The fields of a level that LevelParser.populate may be asked to load,
+# and the kind of entity each is made of.  "actors" are munged to find
+# how to draw them, which reads their scripts and probes their images,
+# while "actors_raw" are only the NPCs as written in the level.  The
+# "effects" field is found in the scripts of the actors.
+LEVEL_FIELDS = {
+    "board" : BoardRow,
+    "links" : Link,
+    "signs" : Sign,
+    "actors" : Actor,
+    "actors_raw" : Actor,
+    "baddies" : Baddy,
+    "treasures" : TreasureBox,
+    "effects" : None,
+}
+
+
+def default_fields(text_only=False, fastmode=False):
+    """
+    Returns the fields loaded by the older text_only and fastmode
+    options of LevelParser.populate.
+    """
+    if text_only:
+        return set(["board", "signs"])
+    fields = set(LEVEL_FIELDS.keys())
+    fields.discard("actors_raw" if not fastmode else "actors")
+    return fields
+
+
+def lazy_section(name):
+    """
+    Creates a property for a level attribute that may be decoded on
+    demand.  See LevelParser.defer.
+    """
+    attr = "_" + name
+
+    def getter(self):
+        loader = self._pending.pop(name, None)
+        if loader:
+            # The loader may read the attribute itself, so it is no
+            # longer pending while it runs.  If it fails, the attribute
+            # is put back as it was and the loader runs again on the
+            # next access, rather than leaving partial data behind.
+            value = getattr(self, attr)
+            saved = list(value) if isinstance(value, list) else value
+            try:
+                loader()
+            except Exception:
+                setattr(self, attr, saved)
+                self._pending[name] = loader
+                raise
+        return getattr(self, attr)
+
+    def setter(self, value):
+        self._pending.pop(name, None)
+        setattr(self, attr, value)
+
+    return property(getter, setter)
+
+
+
+
 class LevelParser(object):
     """
     Baseclass for level parsers to derrive from.
     """
+
+    board = lazy_section("board")
+    links = lazy_section("links")
+    signs = lazy_section("signs")
+    actors = lazy_section("actors")
+    baddies = lazy_section("baddies")
+    treasures = lazy_section("treasures")
+    effects = lazy_section("effects")
+    
+    # File headers and file extensions used by the format.  See
+    # util.register_format.
+    HEADERS = ()
+    EXTENSIONS = ()
     
-    def __init__(self, path):
+    def __init__(self, path, raw=None, header=None):
         self._uri = path
-        with open(self._uri, "r") as reader:
-            self.header = reader.read(8)
+        self._raw = raw
+        if raw is not None:
+            self.header = raw[:8]
+        elif header is not None:
+            self.header = header
+        else:
+            with open(self._uri, "r") as reader:
+                self.header = reader.read(8)
         self.version = self.file_version()
 
-        self.board = [[None for y in range (64)] for x in range(64)]
+        self._pending = {}
+        self.board = Board()
         self.links = []
         self.signs = []
         self.actors = []
@@ -317,15 +826,99 @@ class LevelParser(object):
         self.treasures = []
         self.effects = []
 
+        self.fields = set()
+        self._actor_queue = None
         self._fastmode = False
+        self._fingerprints = {}
 
         
-    def populate(self, text_only=False, fastmode=False):
-        self.parse(text_only)
-        self.actors.sort(self._actor_sort_fn)
-        self.find_area_effects()
+    def populate(self, text_only=False, fastmode=False, fields=None):
+        """
+        Parses the level.  'fields' is the set of LEVEL_FIELDS to load,
+        and every stage of parsing that none of them need is skipped.
+        If it is not given, the fields are chosen by text_only and
+        fastmode, see default_fields.
+        """
+        if fields is None:
+            fields = default_fields(text_only, fastmode)
+        fields = set(fields)
+        unknown = fields.difference(LEVEL_FIELDS.keys())
+        if unknown:
+            raise ValueError("Unknown level fields: %s" % ", ".join(unknown))
+        if "effects" in fields and "actors" not in fields:
+            fields.add("actors_raw")
+
+        self.fields = fields
+        self._fastmode = "actors" not in fields
+        kinds = tuple(set(LEVEL_FIELDS[field] for field in fields
+                          if LEVEL_FIELDS[field] is not None))
+        self.parse(kinds)
+        if Actor in kinds:
+            self.defer("actors", self.order_actors)
+        if "effects" in fields:
+            self.defer("effects", self.find_area_effects)
+
+
+    def order_actors(self):
+        """
+        Sorts the actors into drawing order.  The RenderQueue used to do
+        so is kept for render_queue, so that the sort key of each actor
+        is only computed once.
+        """
+        queue = RenderQueue(self.actors)
+        self.actors[:] = list(queue)
+        self._actor_queue = queue
+
 
-        self._fastmode = fastmode
+    def defer(self, name, loader):
+        """
+        Registers a function to be called the first time the named
+        attribute is accessed, such as "links" or "board".  If a loader
+        is already pending for that attribute, the new one runs after
+        it.
+        """
+        pending = self._pending.get(name)
+        if pending:
+            def chained():
+                pending()
+                loader()
+            self._pending[name] = chained
+        else:
+            self._pending[name] = loader
+
+        
+    def read_raw(self):
+        """
+        Returns the contents of the level file.  The file is only read
+        if its contents were not already passed to the constructor.
+        """
+        if self._raw is None:
+            with self.open_level() as reader:
+                self._raw = reader.read()
+        return self._raw
+
+
+    def open_level(self):
+        """
+        Returns a file object for reading the level, which reads from
+        the contents passed to the constructor if there were any.
+        """
+        if self._raw is not None:
+            return closing(StringIO(self._raw))
+        return open(self._uri, "r")
+
+
+    def resolve(self):
+        """
+        Decodes every section of the level that has not yet been
+        accessed, after which the contents of the level file are no
+        longer kept.  Neither is the queue the actors were ordered
+        with, as levels are resolved to be kept in memory in bulk.
+        """
+        while self._pending:
+            getattr(self, self._pending.keys()[0])
+        self._raw = None
+        self._actor_queue = None
 
         
     def file_version(self):
@@ -334,9 +927,34 @@ class LevelParser(object):
         raise NotImplementedError("Baseclass method.")
 
         
-    def parse(self):
+    def iter_entities(self, kinds=ENTITY_TYPES, fastmode=False):
+        """
+        Reads the level file and yields a record for each board row
+        and entity as it is decoded.  Only records that are instances
+        of one of the given kinds are decoded and yielded, so callers
+        should ask for as little as they need, and may stop iterating
+        once they have it.
+        """
         raise NotImplementedError("Baseclass method.")
 
+
+    def parse(self, kinds=ENTITY_TYPES):
+        """
+        Decodes the board rows and entities of the given kinds.
+        """
+        self.add_entities(self.iter_entities(kinds, self._fastmode))
+
+
+    def add_entities(self, entities):
+        """
+        Adds each of the records yielded by iter_entities to the level.
+        """
+        for entity in entities:
+            if type(entity) == BoardRow:
+                self.board.set_row(entity.y, entity.tiles)
+            else:
+                getattr(self, ENTITY_LISTS[type(entity)]).append(entity)
+
     
     def add_link(self, target, link_x, link_y, width, height, dest_x, dest_y):
         link = Link(target, link_x, link_y, width, height, dest_x, dest_y)
@@ -359,16 +977,46 @@ class LevelParser(object):
         self.signs.append(Sign(x, y, text))
 
 
+    def render_queue(self, baddies=True):
+        """
+        Returns a RenderQueue of the level's actors, along with stand-ins
+        for its baddies unless 'baddies' is False.
+        """
+        actors = self.actors
+        if self._actor_queue is not None and \
+           len(self._actor_queue) == len(actors):
+            queue = self._actor_queue.copy()
+        else:
+            queue = RenderQueue(actors)
+        if baddies:
+            for baddy in self.baddies:
+                fake = baddy.make_fake_actor()
+                if fake:
+                    queue.add(fake)
+        return queue
+
+
     def extract_text(self):
         return [sign.text for sign in self.signs]
 
 
+    def fingerprints(self, digest=DEFAULT_DIGEST):
+        """
+        Returns a dict of the tile, pallet, content, and level hashes,
+        which are computed together the first time any of them is
+        needed.  See fingerprint.DIGESTS for the available digests.
+        """
+        if not self._fingerprints.has_key(digest):
+            self._fingerprints[digest] = level_fingerprints(self, digest)
+        return self._fingerprints[digest]
+
+
     def tile_hash(self):
         """
         Used for quickly comparing two levels to see if they have
         identical tile arrangements.
         """
-        return hashlib.sha1(str(self.board)).hexdigest()
+        return self.fingerprints()["tile_hash"]
 
 
     def pallet_hash(self):
@@ -377,9 +1025,7 @@ class LevelParser(object):
         different arrangements but which use the same tiles will have a
         different pallet hash.
         """
-        pallet = list(set(itertools.chain.from_iterable(self.board)))
-        pallet.sort()
-        return hashlib.sha1(str(pallet)).hexdigest()
+        return self.fingerprints()["pallet_hash"]
 
 
     def content_hash(self):
@@ -389,10 +1035,7 @@ class LevelParser(object):
 
         Level links and treasure boxes are omitted here.
         """
-        combined = ''
-        for entity in self.actors + self.baddies + self.signs:
-            combined += str(entity.original_inputs)
-        return hashlib.sha1(str(combined)).hexdigest()
+        return self.fingerprints()["content_hash"]
 
 
     def level_hash(self):
@@ -402,10 +1045,7 @@ class LevelParser(object):
         useful for png or text export, so as to be able to skip over
         approximate duplicates.
         """
-        combined = str(self.board)
-        for entity in self.actors + self.baddies + self.signs:
-            combined += str(entity.original_inputs)
-        return hashlib.sha1(str(combined)).hexdigest()
+        return self.fingerprints()["level_hash"]
 
 
     def print_debug_info(self):
@@ -453,36 +1093,7 @@ class LevelParser(object):
             found = re.findall(pattern, npc.src)
             if found:
                 try:
-                    self.effects.append(map(lambda x: float(eval(x)) if len(x) > 0 else 0.0, found[0]))
+                    self.effects.append(map(lambda x: float(evaluate(x)) if len(x) > 0 else 0.0, found[0]))
                 except Exception as error:
                     print "error parsing:", found[0]
                     print error
-
-                    
-    def _actor_sort_fn(self, lhs, rhs):
-        if lhs.layer < rhs.layer:
-            return -1
-        elif lhs.layer > rhs.layer:
-            return 1
-
-        lhs_height = lhs.zoom[3] if lhs.zoom else lhs.clip[3]
-        lhs_x = lhs.zoom[0] if lhs.zoom else lhs.x
-        lhs_y = lhs.zoom[1] if lhs.zoom else lhs.y
-
-        rhs_height = rhs.zoom[3] if rhs.zoom else rhs.clip[3]
-        rhs_x = rhs.zoom[0] if rhs.zoom else rhs.x
-        rhs_y = rhs.zoom[1] if rhs.zoom else rhs.y
-
-        a = lhs_y + (lhs_height / TILE_SIZE)
-        b = rhs_y + (rhs_height / TILE_SIZE)
-            
-        if a < b:
-            return -1
-        elif a > b:
-            return 1
-        elif lhs_x < rhs_x:
-            return -1
-        elif lhs_x > rhs_x:
-            return 1
-        else:
-            return 0
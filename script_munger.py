@@ -16,59 +16,68 @@
 
 
 import re
+import copy
+import hashlib
+import operator
+from caching import LRUCache, StoredCache, register_cache
 
 
-def find_blocks(src, start=0, nesting=0, scope=None):
-    if not scope:
-        scope = []
-    seek = start;
-    accumulate = ''
-    while seek < (len(src)):
-        chunk = re.match(
-            r'^(.*?)({|}|\n|\Z|//.*?(?:\n|\Z)|/\*.*?(?:\*/|\Z))',
-            src[seek:], re.MULTILINE | re.DOTALL)
-        if chunk:
-            seek += (chunk.end() - chunk.start())
-            text, event = chunk.groups()
-            assert(text.count("}") == 0)
-            if event.strip():
-                if event == '{':
-                    if accumulate:
-                        scope.append(accumulate)
-                        accumulate = ''
-                    seek, new_scope = find_blocks(
-                        src, seek, nesting+1, [text + event])
-                    scope.append(new_scope)
-                    continue
-                    
-                accumulate += text
-                accumulate += event
-                                        
-                if event == '}':
-                    if accumulate:
-                        scope.append(accumulate)
-                    if nesting != 0:
-                        return seek, scope
-                    else:
-                        print "unexpected closing parenthesis"
-            else:
-                accumulate += text
-                if event:
-                    accumulate += event
-        else:
-            print "error parsing script, returning early"
-            if accumulate:
-                scope.append(accumulate)
-            if nesting == 0:
-                return scope
+# Commands found by find_immediates are kept between runs, keyed on this
+# version.  It must be bumped whenever find_blocks or find_immediates
+# change what they return, so that results of older code are not used.
+IMMEDIATES_VERSION = 1
+
+
+# The braces and comments that find_blocks splits scripts on.  Strings
+# are matched only so that the braces and comments within them are
+# skipped.
+BLOCK_EVENTS = re.compile(
+    r'"(?:[^"\\\n]|\\[^\n])*"?|[{}]|//[^\n]*\n?|/\*.*?(?:\*/|\Z)',
+    re.DOTALL)
+
+
+def find_blocks(src):
+    """
+    Splits a script into a nested list of blocks.  Each block is a list
+    whose first item is the line leading up to and including its opening
+    brace, followed by the text and nested blocks within it, with the
+    last text item ending in the closing brace.
+    """
+    scope = []
+    stack = []
+    # the text that will become the next item of the current scope
+    # starts at text_start, and last_end is the end of the last event
+    text_start = last_end = 0
+    for event in BLOCK_EVENTS.finditer(src):
+        token = event.group()
+        if token[0] == '"':
+            continue
+        start, end = event.span()
+        if token == '{':
+            line_start = max(last_end, src.rfind('\n', last_end, start) + 1)
+            if text_start < line_start:
+                scope.append(src[text_start:line_start])
+            stack.append(scope)
+            scope = [src[line_start:end]]
+            text_start = end
+        elif token == '}':
+            scope.append(src[text_start:end])
+            if stack:
+                block = scope
+                scope = stack.pop()
+                scope.append(block)
+                text_start = end
             else:
-                return len(src), scope
-    if accumulate:
-        scope.append(accumulate)
-    if nesting == 0:
-        return scope
-    else:
-        return len(src), scope
+                print "unexpected closing parenthesis"
+        last_end = end
+
+    if text_start < len(src):
+        scope.append(src[text_start:])
+    while stack:
+        block = scope
+        scope = stack.pop()
+        scope.append(block)
+    return scope
 
 
 def find_immediates(src):
@@ -118,3 +127,344 @@ def find_immediates(src):
                     command.strip()]
 
     return reduced
+
+
+class ExpressionError(ValueError):
+    pass
+
+
+# Tokens of the arithmetic expressions understood by evaluate.
+EXPRESSION_TOKEN = re.compile(
+    r'\s*(?:(\d+\.?\d*|\.\d+)|([A-Za-z_]\w*)|([-+*/()]))')
+
+
+# Binary operators, by the precedence level they are parsed at.  These
+# follow python 2, so dividing two integers rounds down.
+TERM_OPERATORS = {
+    "+" : operator.add,
+    "-" : operator.sub,
+}
+FACTOR_OPERATORS = {
+    "*" : operator.mul,
+    "/" : operator.div,
+}
+
+
+# The largest magnitude of any number in an expression, or of the result
+# of any operation in it.  Positions and image sizes in levels are far
+# smaller, and the bound keeps the arithmetic cheap on hostile scripts.
+MAX_MAGNITUDE = 10 ** 9
+
+
+def bounded(value, source):
+    if abs(value) > MAX_MAGNITUDE:
+        raise ExpressionError("Number out of range: %r" % source)
+    return value
+
+
+# Parsed expressions, by their source text.
+EXPRESSION_CACHE = register_cache("expression", LRUCache(4096))
+
+
+def tokenize_expression(source):
+    tokens = []
+    seek = 0
+    source = source.rstrip()
+    while seek < len(source):
+        found = EXPRESSION_TOKEN.match(source, seek)
+        if not found:
+            raise ExpressionError("Invalid expression: %r" % source)
+        number, name, symbol = found.groups()
+        if number is not None:
+            tokens.append(("number", parse_number(number, source)))
+        elif name is not None:
+            tokens.append(("name", name))
+        else:
+            tokens.append((symbol, None))
+        seek = found.end()
+    return tokens
+
+
+def parse_number(text, source):
+    if "." in text:
+        return float(text)
+    if len(text) > 1 and text.startswith("0"):
+        # python 2 reads integers with a leading zero as octal
+        try:
+            return int(text, 8)
+        except ValueError:
+            raise ExpressionError("Invalid expression: %r" % source)
+    return int(text)
+
+
+def parse_expression(source):
+    """
+    Parses an arithmetic expression made of numbers, variable names,
+    parenthesis, and the + - * / operators, and returns a function that
+    evaluates it given a dict of variables.  Raises ExpressionError if
+    the source is not such an expression, or if any number in it is
+    larger than MAX_MAGNITUDE.
+    """
+    tokens = tokenize_expression(source)
+    scope = {"seek" : 0, "names" : False}
+
+    def peek():
+        if scope["seek"] < len(tokens):
+            return tokens[scope["seek"]][0]
+        return None
+
+    def take():
+        token = tokens[scope["seek"]]
+        scope["seek"] += 1
+        return token
+
+    def binary(operators, operand):
+        node = operand()
+        while peek() in operators:
+            op = operators[take()[0]]
+            node = (lambda op, lhs, rhs: lambda env:
+                    bounded(op(lhs(env), rhs(env)), source))(
+                        op, node, operand())
+        return node
+
+    def expression():
+        return binary(TERM_OPERATORS, term)
+
+    def term():
+        return binary(FACTOR_OPERATORS, factor)
+
+    def factor():
+        signs = []
+        while peek() in ("+", "-"):
+            signs.append(take()[0])
+        node = atom()
+        for sign in reversed(signs):
+            op = operator.neg if sign == "-" else operator.pos
+            node = (lambda op, node: lambda env: op(node(env)))(op, node)
+        return node
+
+    def atom():
+        kind = peek()
+        if kind == "number":
+            value = bounded(take()[1], source)
+            return lambda env: value
+        elif kind == "name":
+            name = take()[1]
+            scope["names"] = True
+            def lookup(env):
+                try:
+                    return bounded(env[name], source)
+                except KeyError:
+                    raise ExpressionError("Unknown variable: %s" % name)
+            return lookup
+        elif kind == "(":
+            take()
+            node = expression()
+            if peek() != ")":
+                raise ExpressionError("Invalid expression: %r" % source)
+            take()
+            return node
+        raise ExpressionError("Invalid expression: %r" % source)
+
+    parsed = expression()
+    if peek() is not None:
+        raise ExpressionError("Invalid expression: %r" % source)
+
+    if not scope["names"]:
+        # most expressions are constant, so work those out up front
+        try:
+            value = parsed({})
+            return lambda env: value
+        except ArithmeticError:
+            pass
+    return parsed
+
+
+def evaluate(source, variables={}):
+    """
+    Safely evaluates an arithmetic expression from a script, such as
+    "x + 1.5".  See parse_expression.  Parsed expressions are cached,
+    so evaluating the same source again only does the arithmetic.
+    """
+    parsed = EXPRESSION_CACHE.get(source)
+    if parsed is None:
+        parsed = parse_expression(source)
+        EXPRESSION_CACHE[source] = parsed
+    return parsed(variables)
+
+
+# Patterns for the rendering directives recognized by find_directives.
+# Each is matched against one command from find_immediates, including
+# its trailing semicolon.
+X_OFFSET_PATTERNS = [
+    r'^ *x ?(=) ?((?:x? ?[\d/*+\-. ]+)|(?:[\d/*+\-. ]+ ?x?)) ?;',
+    r'^ *x ?(\+=|\-=) ?([\d/*+\-. ]+) ?;',
+]
+OFFSET_PATTERNS = {
+    'x' : [re.compile(regex) for regex in X_OFFSET_PATTERNS],
+    'y' : [re.compile(regex.replace('x', 'y')) for regex in X_OFFSET_PATTERNS],
+}
+
+IMG_PART_PATTERN = re.compile(
+    r'set(?:img|gif)part ([^\s]+?) ?, ?([\d/*+-]+) ??, ?([\d/*+-]+) ??, ?([\d/*+-]+) ??, ?([\d/*+-]+) ?;')
+COLOR_EFFECT_PATTERN = re.compile(
+    r'setcoloreffect ?([\d/*.+-]+) ?, ?([\d/*.+-]+)?, ?([\d/*.+-]+)?, ?([\d/*.+-]+);')
+ZOOM_EFFECT_PATTERN = re.compile(r'setzoomeffect ?([\d/*.+-]+) ?;')
+
+
+# Drawing layer directives, from highest to lowest precedence.
+LAYER_DIRECTIVES = (
+    ("drawaslight", 2),
+    ("drawunderplayer", -1),
+    ("drawoverplayer", 1),
+)
+
+
+# Directives that make up the whole of a command, and so can be found
+# by the end of the command alone.
+FLAG_DIRECTIVES = ("hide",) + tuple(name for name, layer in LAYER_DIRECTIVES)
+
+
+
+
+# Directives found by find_directives are kept between runs along with
+# the commands they were found in, keyed on this version and on
+# IMMEDIATES_VERSION.  It must be bumped whenever find_directives or the
+# fields of ActorDirectives change.
+DIRECTIVES_VERSION = 1
+
+
+class ActorDirectives(object):
+    """
+    The rendering directives found in the immediate commands of an NPC
+    script.  Values are kept as the expressions written in the script,
+    and are evaluated by Actor.apply_directives.  Where a directive
+    appears more than once, the first one found is used.
+    """
+    def __init__(self):
+        self.moves = {} # axis -> (operator, expression)
+        self.hide = False
+        self.image_part = None # (image name, [x, y, w, h] expressions)
+        self.layer = None
+        self.effect = None # (r, g, b, a) expressions
+        self.zoom = None # expression
+        self.joins = [] # names of scripts to include
+
+        self._offsets = {}
+        self._layer_rank = len(LAYER_DIRECTIVES)
+
+    def copy(self):
+        """
+        Returns a copy that find_directives may continue without
+        changing this one.
+        """
+        copied = copy.copy(self)
+        copied.moves = dict(self.moves)
+        copied.joins = list(self.joins)
+        copied._offsets = dict(self._offsets)
+        return copied
+
+
+def find_directives(commands, directives=None):
+    """
+    Scans a list of commands, as returned by find_immediates, in one
+    pass for rendering directives.  Passing the ActorDirectives from a
+    previous scan continues it, such as for the scripts named by join
+    commands.
+    """
+    if directives is None:
+        directives = ActorDirectives()
+    offsets = directives._offsets
+
+    # Each test below is cheap and rules out most commands, so that
+    # the patterns are only tried against likely matches.
+    for command in commands:
+        first = command[:1]
+        if first == "x" or first == "y":
+            line = command + ";"
+            for rank, pattern in enumerate(OFFSET_PATTERNS[first]):
+                if not offsets.has_key((first, rank)):
+                    found = pattern.match(line)
+                    if found:
+                        offsets[(first, rank)] = found.groups()
+
+        elif first == "j" and command.startswith("join "):
+            directives.joins.append(command[5:])
+
+        if command.endswith(FLAG_DIRECTIVES):
+            if command.endswith("hide"):
+                directives.hide = True
+            for rank, (name, layer) in enumerate(LAYER_DIRECTIVES):
+                if rank < directives._layer_rank and command.endswith(name):
+                    directives.layer = layer
+                    directives._layer_rank = rank
+
+        if directives.image_part is None and "part " in command:
+            found = IMG_PART_PATTERN.search(command + ";")
+            if found:
+                groups = found.groups()
+                directives.image_part = (groups[0], list(groups[1:]))
+
+        if "effect" in command:
+            if directives.effect is None and "setcoloreffect" in command:
+                found = COLOR_EFFECT_PATTERN.search(command + ";")
+                if found:
+                    directives.effect = found.groups('')
+
+            if directives.zoom is None and "setzoomeffect" in command:
+                found = ZOOM_EFFECT_PATTERN.search(command + ";")
+                if found:
+                    directives.zoom = found.group(1)
+
+    for axis, patterns in OFFSET_PATTERNS.iteritems():
+        for rank in range(len(patterns)):
+            if offsets.has_key((axis, rank)):
+                directives.moves[axis] = offsets[(axis, rank)]
+                break
+
+    return directives
+
+
+# The results of analyze_script by a hash of the script source.  These
+# are also kept between runs in SCRIPT_STORE, if store_script_analyses
+# has been called.
+SCRIPT_ANALYSES = register_cache("script", LRUCache(2048))
+SCRIPT_STORE = None
+
+
+def store_script_analyses():
+    """
+    Keeps the results of analyze_script in the cache directory, where
+    they are shared with later runs and other processes.
+    """
+    global SCRIPT_STORE
+    if SCRIPT_STORE is None:
+        name = repr(("script_analyses", IMMEDIATES_VERSION, DIRECTIVES_VERSION))
+        SCRIPT_STORE = register_cache(
+            "stored script", StoredCache("scripts", name, retain=False))
+
+
+def analyze_script(src):
+    """
+    Returns the immediate commands of an NPC script, as returned by
+    find_immediates, and the ActorDirectives found in them.  The same
+    scripts are used by many NPCs, so the results are cached by a hash
+    of the source, and must not be modified by the caller.
+    """
+    if type(src) == unicode:
+        key = "u" + src.encode("utf-8")
+    else:
+        key = "s" + src
+    key = hashlib.sha1(key).digest()
+
+    analysis = SCRIPT_ANALYSES.get(key)
+    if analysis is None:
+        if SCRIPT_STORE is not None:
+            analysis = SCRIPT_STORE.lookup(key)
+        if analysis is None:
+            commands = find_immediates(src)
+            analysis = (commands, find_directives(commands))
+            if SCRIPT_STORE is not None:
+                SCRIPT_STORE.store(key, analysis)
+        SCRIPT_ANALYSES[key] = analysis
+    return analysis
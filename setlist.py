@@ -7,10 +7,15 @@ from multiprocessing import Pool
 from sh import find
 from util import load_level
 from parser_common import UnknownFileHeader
+from caching import cache_stats, merge_cache_stats, print_cache_stats
+
+
+# The parts of each level that process_level uses.
+SCAN_FIELDS = ("board", "links", "signs", "actors_raw", "baddies", "treasures")
 
 
 # Generate a new UUID to invalidate an old level database.
-DATABASE_VERSION = "37590c47-f652-4cb8-864e-db18c0e5e5e7"
+DATABASE_VERSION = "923531b1-c5ac-4633-9c53-717a3fe673d2"
 
 
 def process_level(path):
@@ -18,7 +23,7 @@ def process_level(path):
         return None
 
     try:
-        level = load_level(path, fast_mode = True)
+        level = load_level(path, fields=SCAN_FIELDS)
     except UnknownFileHeader:
         return None
 
@@ -43,9 +48,10 @@ def process_level(path):
     if north or east or south or west:
         edges = (north, east, south, west)
 
+    fingerprints = level.fingerprints()
     return {
-        "level_hash" : level.level_hash(),
-        "pallet_hash" : level.pallet_hash(),
+        "level_hash" : fingerprints["level_hash"],
+        "pallet_hash" : fingerprints["pallet_hash"],
         "path" : path,
         "doors" : doors,
         "edges" : edges,
@@ -56,6 +62,15 @@ def process_level(path):
     }
 
 
+def scan_level(path):
+    """
+    Runs process_level in a worker process, and returns the cache stats
+    of the worker along with the results.
+    """
+    data = process_level(path)
+    return os.getpid(), cache_stats(), data
+
+
 def build_level_database(input_path):
     print "Generating or regenerating level database."
     print "This may take a long time if a lot of files need to be scanned."
@@ -67,7 +82,9 @@ def build_level_database(input_path):
     ratio = 100.0 / len(paths)
     processed = 0
     last_percent = 0
-    for data in pool.imap_unordered(process_level, paths):
+    worker_stats = {}
+    for worker, stats, data in pool.imap_unordered(scan_level, paths):
+        worker_stats[worker] = stats
         processed += 1
         percent = int(processed * ratio)
         if percent > last_percent:
@@ -78,6 +95,8 @@ def build_level_database(input_path):
             continue
         levels.append(data)
 
+    print_cache_stats(merge_cache_stats(worker_stats.values()))
+
     db = {
         "levels" : levels,
         "version" : DATABASE_VERSION,
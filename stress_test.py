@@ -9,9 +9,17 @@ from util import load_level
 from multiprocessing import Pool, cpu_count
 
 
+# Everything a conversion loads.  NPC scripts are munged and searched for
+# area effects too, as malformed scripts are what most often break a
+# conversion.  Sprites that can't be found are skipped.
+TEST_FIELDS = ("board", "links", "signs", "actors", "baddies", "treasures",
+               "effects")
+
+
 def run_test(path):
     try:
-        level = load_level(path)
+        level = load_level(path, fields=TEST_FIELDS)
+        level.resolve()
         return False
     except:
         return True
@@ -0,0 +1,226 @@
+
+#  Copyright (c) 2017, Aeva M. Palecek
+
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tilesets such as pics1.png are decoded once per process and shared by
+# every level drawn with them, rather than being opened and cut into
+# separate tile images for each level.
+
+import os
+from PIL import Image
+from parser_common import TILE_SIZE, TILE_COORDS
+from caching import cache_file, load_cache, save_cache
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Tileset(object):
+    """
+    A tileset decoded into a single RGBA image.  Tiles are addressed by
+    their x,y coordinate within the tileset, see TILE_COORDS, and are
+    cropped from the image the first time they are used.
+
+    Tilesets that are palette images also keep the palette indices of
+    their pixels, so that levels may be drawn without expanding every
+    pixel to RGBA.  See the 'indexed' arguments below.
+    """
+    def __init__(self, image, indexed=None):
+        self.image = image
+        self.indexed = indexed
+        self.columns = image.size[0] / TILE_SIZE
+        self.rows = image.size[1] / TILE_SIZE
+        self.tiles = {}
+        self.atlases = {}
+        self.lookup = None
+        self.palette = None
+        self.fill_index = None
+        if indexed is not None:
+            self.find_fill_index()
+
+    def find_fill_index(self):
+        """
+        Finds the palette index drawn for tiles outside of the tileset,
+        which must appear black once the alpha channel is dropped.  An
+        unused index is made black if there is no black in the palette.
+        If every index is in use, there is no fill index, and only the
+        boards that stay within the tileset can be drawn indexed.
+        """
+        palette = self.indexed.getpalette()
+        colors = [tuple(palette[i:i+3]) for i in range(0, len(palette), 3)]
+        if (0, 0, 0) in colors:
+            self.fill_index = colors.index((0, 0, 0))
+        else:
+            for index, count in enumerate(self.indexed.histogram()):
+                if count == 0 and index < len(colors):
+                    palette[index * 3:index * 3 + 3] = [0, 0, 0]
+                    self.fill_index = index
+                    break
+        self.palette = palette
+
+    def can_index(self, tiles):
+        """
+        Returns True if the given tile indices can be drawn as a palette
+        image, see generate_map in nw2png.
+        """
+        if self.indexed is None:
+            return False
+        if self.fill_index is not None:
+            return True
+        return all(self.has_tile(*TILE_COORDS[tile_index])
+                   for tile_index in set(tiles))
+
+    def has_tile(self, tile_x, tile_y):
+        return 0 <= tile_x < self.columns and 0 <= tile_y < self.rows
+
+    def tile(self, tile_x, tile_y, indexed=False):
+        """
+        Returns the image of the given tile, or None if the coordinate
+        is outside of the tileset.
+        """
+        key = (tile_x, tile_y, indexed)
+        tile = self.tiles.get(key)
+        if tile is None:
+            if not self.has_tile(tile_x, tile_y):
+                return None
+            left = tile_x * TILE_SIZE
+            top = tile_y * TILE_SIZE
+            box = (left, top, left + TILE_SIZE, top + TILE_SIZE)
+            image = self.indexed if indexed else self.image
+            tile = self.tiles[key] = image.crop(box)
+        return tile
+
+    def gather(self, board_tiles, fill=(0, 0, 0, 0), indexed=False):
+        """
+        Takes a numpy array of tile indices, such as from Board.as_numpy,
+        and returns a numpy array of the pixels of those tiles laid out
+        in the same arrangement.  Tiles outside of the tileset are drawn
+        in the fill color.  Requires numpy.
+
+        If indexed is True, the palette indices of the pixels are
+        returned instead, and the fill is always self.fill_index.
+        """
+        if self.lookup is None:
+            # the position in the atlas of every tile index, see atlas
+            fill_tile = self.rows * self.columns
+            self.lookup = numpy.array(
+                [tile_y * self.columns + tile_x
+                 if self.has_tile(tile_x, tile_y) else fill_tile
+                 for tile_x, tile_y in TILE_COORDS],
+                numpy.intp)
+
+        if indexed:
+            atlas = self.atlas(self.indexed, self.fill_index or 0)
+        else:
+            atlas = self.atlas(self.image)
+            atlas[-1] = fill
+        height, width = board_tiles.shape
+        gathered = atlas[self.lookup[board_tiles]]
+        gathered = gathered.swapaxes(1, 2)
+        return gathered.reshape(
+            (height * TILE_SIZE, width * TILE_SIZE) + atlas.shape[3:])
+
+    def atlas(self, image, fill=0):
+        """
+        Returns the tiles of the RGBA or indexed image as an array of
+        shape (tile count + 1, 16, 16, ...), in which the last tile is
+        reserved for the fill color.
+        """
+        atlas = self.atlases.get(image.mode)
+        if atlas is None:
+            rows, columns = self.rows, self.columns
+            pixels = numpy.asarray(image)
+            pixels = pixels[:rows * TILE_SIZE, :columns * TILE_SIZE]
+            channels = pixels.shape[2:]
+            tiles = pixels.reshape(
+                (rows, TILE_SIZE, columns, TILE_SIZE) + channels)
+            tiles = tiles.swapaxes(1, 2).reshape(
+                (rows * columns, TILE_SIZE, TILE_SIZE) + channels)
+            fill_tile = numpy.empty((1,) + tiles.shape[1:], tiles.dtype)
+            fill_tile[:] = fill
+            atlas = numpy.concatenate([tiles, fill_tile])
+            self.atlases[image.mode] = atlas
+        return atlas
+
+
+
+
+# Decoded tilesets by absolute path, along with the (mtime, size) of
+# the file when it was decoded.  See load_tileset.
+TILESETS = {}
+
+
+# Whether decoded tilesets are also kept in the cache directory, so
+# that later runs need not decode the image file again.  See
+# store_decoded_tilesets.
+STORE_TILESETS = False
+
+
+# The version of the data decode_tileset keeps in the cache directory,
+# which is part of the cache key so that a change to it is never read
+# back in the old format.
+CACHE_VERSION = 1
+
+
+def store_decoded_tilesets():
+    global STORE_TILESETS
+    STORE_TILESETS = True
+
+
+def decode_tileset(tiles_path, stamp):
+    """
+    Returns the RGBA image of the tileset, along with the image of its
+    palette indices if it is a palette image.
+    """
+    cached_path = cache_file(
+        "tilesets", repr((CACHE_VERSION, tiles_path, stamp)))
+    if STORE_TILESETS:
+        cached = load_cache(cached_path)
+        if cached is not None:
+            size, data, indices, palette = cached
+            indexed = None
+            if indices is not None:
+                indexed = Image.frombytes("P", size, indices)
+                indexed.putpalette(palette)
+            return Image.frombytes("RGBA", size, data), indexed
+
+    source = Image.open(tiles_path)
+    image = source.convert("RGBA")
+    indexed = source if source.mode == "P" else None
+    if STORE_TILESETS:
+        indices = palette = None
+        if indexed is not None:
+            indices, palette = indexed.tobytes(), indexed.getpalette()
+        save_cache(cached_path, (image.size, image.tobytes(), indices, palette))
+    return image, indexed
+
+
+def load_tileset(tiles_path):
+    """
+    Returns the Tileset for the given image file, which is decoded only
+    the first time it is needed, or again if the file changes.
+    """
+    key = os.path.abspath(tiles_path)
+    stat = os.stat(key)
+    stamp = (stat.st_mtime, stat.st_size)
+    cached = TILESETS.get(key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    tileset = Tileset(*decode_tileset(key, stamp))
+    TILESETS[key] = (stamp, tileset)
+    return tileset
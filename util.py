@@ -15,31 +15,95 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import os
 from nw_parser import DotNWParser
 from graal_parser import DotGraalParser
-from parser_common import UnknownFileHeader
+from parser_common import UnknownFileHeader, ENTITY_TYPES, Sign
+
+
+# Maps every known file header to the parser for its format.
+LEVEL_FORMATS = {}
+
+
+# Maps the file extensions typically used by levels to the parser they
+# hint at.  The file header always has the final say.
+LEVEL_EXTENSIONS = {}
+
+
+# All of the file headers are this many bytes long.
+HEADER_SIZE = 8
+
+
+def register_format(parser):
+    for header in parser.HEADERS:
+        assert len(header) == HEADER_SIZE
+        LEVEL_FORMATS[header] = parser
+    for extension in parser.EXTENSIONS:
+        LEVEL_EXTENSIONS[extension] = parser
+
+
+register_format(DotNWParser)
+register_format(DotGraalParser)
+
+
+def sniff_level_format(level_path):
+    """
+    Returns the parser class for the given file by reading only its
+    header, or None if the file is not a level.
+    """
+    with open(level_path, "r") as reader:
+        return LEVEL_FORMATS.get(reader.read(HEADER_SIZE))
+
+
+def has_level_extension(path):
+    """
+    Returns True if the file extension of the path is one typically
+    used for level files.
+    """
+    return LEVEL_EXTENSIONS.has_key(os.path.splitext(path)[1].lower())
 
 
 def find_level_parser(level_path):
-    for parser in [DotNWParser, DotGraalParser]:
-        try:
-            return parser(level_path)
-        except UnknownFileHeader:
-            continue
-    raise UnknownFileHeader("Unable to determine level file format: %s" % level_path)
+    """
+    Returns a parser for the given level file, chosen by its header.
+    Only the header is read here, and the parser is given it so that
+    the rest of the file is only opened when the level is parsed.  .nw
+    levels are then still read a line at a time.
+    """
+    with open(level_path, "r") as reader:
+        header = reader.read(HEADER_SIZE)
+    parser = LEVEL_FORMATS.get(header)
+    if parser is None:
+        raise UnknownFileHeader(
+            "Unable to determine level file format: %s" % level_path)
+    return parser(level_path, header=header)
 
 
-def load_level(level_path, text_only=False, fast_mode = False):
+def load_level(level_path, text_only=False, fast_mode = False, fields=None):
+    """
+    Loads a level file.  Tools should pass the set of fields they need,
+    such as fields=("board", "signs"), so that parsing skips everything
+    else.  See parser_common.LEVEL_FIELDS for the available fields.
+    """
     level = find_level_parser(level_path)
-    level.populate(text_only, fast_mode)
+    level.populate(text_only, fast_mode, fields)
     return level
 
 
+def iter_entities(level_path, kinds=ENTITY_TYPES, fast_mode=True):
+    """
+    Yields the board rows and entities of the given level file as they
+    are read, without collecting them into a level object.  See
+    LevelParser.iter_entities.
+    """
+    level = find_level_parser(level_path)
+    return level.iter_entities(kinds, fast_mode)
+
+
 def level_debug_info(level_path):
     level = load_level(level_path)
     level.print_debug_info()
 
 
 def extract_text(level_path):
-    level = load_level(level_path, text_only=True)
-    return level.extract_text()
+    return [sign.text for sign in iter_entities(level_path, (Sign,))]